@@ -0,0 +1,326 @@
+"""Benchmarks for the uoccin plugins on synthetic libraries.
+
+Generates a uoccin.json file (plus a set of diff files) for each library size, then times the main entry points of the
+uoccin plugins with the imdb/tvdb lookups stubbed out. Requires FlexGet installed (the plugins are imported from the
+plugins folder of this repository).
+
+Every run starts from a cold library: the uoccin folder is restored, the in-memory caches are dropped and the sqlite
+database (with --backends sqlite) is imported again, so its timings include the import.
+
+Usage::
+
+    python benchmarks/uoccin_bench.py --sizes 1000,10000,50000 --output bench_output.json
+
+The results are written as json, so two runs (i.e. before and after a change) can be compared with any diff tool.
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from flexget import logger as flexget_logger
+# must be done before importing the plugins, which create their loggers at import time
+flexget_logger.initialize(unit_test=True)
+
+import flexget.plugins
+flexget.plugins.__path__.append(os.path.join(ROOT, 'plugins'))
+
+from flexget import plugin
+from flexget.entry import Entry
+from flexget.plugins import uoccin_data, uoccin_emit, uoccin_lookup, uoccin_processors
+
+TAGS = ['hires', 'netflix', 'favorite', 'kids', 'anime', 'documentary']
+UUID = 'bench'
+
+
+class StubSeries(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def stub_lookup_series(tvdb_id=None, **kwargs):
+    return StubSeries('Series %s' % tvdb_id)
+
+
+class StubImdbLookup(object):
+    def lookup(self, entry, **kwargs):
+        entry['imdb_name'] = 'Movie %s' % entry['imdb_id']
+
+
+def install_stubs():
+    """Replaces the imdb/tvdb lookups used by the uoccin plugins with instant ones."""
+    uoccin_processors.lookup_series = stub_lookup_series
+    uoccin_emit.lookup_series = stub_lookup_series
+    stub = StubImdbLookup()
+    get_plugin_by_name = plugin.get_plugin_by_name
+
+    class StubPlugin(object):
+        instance = stub
+
+    def get_plugin(name, *args, **kwargs):
+        if name == 'imdb_lookup':
+            return StubPlugin
+        return get_plugin_by_name(name, *args, **kwargs)
+
+    plugin.get_plugin_by_name = get_plugin
+
+
+class Bag(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def fake_task(config_base, entries=None):
+    entries = entries or []
+    return Bag(name='uoccin_bench', manager=Bag(config_base=config_base), options=Bag(uoccin_compact_diffs=False),
+               entries=entries, accepted=entries)
+
+
+def create_plugin(cls, name):
+    instance = cls()
+    instance.log = logging.getLogger(name)
+    return instance
+
+
+def make_library(rnd, size):
+    """Returns a document with size series (plus size / 2 movies), a quarter of them still unnamed."""
+    udata = {'movies': {}, 'series': {}}
+    for i in range(size // 2):
+        mov = {'name': 'N/A' if i % 4 == 0 else 'Movie tt%07d' % i, 'watchlist': rnd.random() < 0.5,
+               'collected': rnd.random() < 0.5, 'watched': rnd.random() < 0.3}
+        if not (mov['watchlist'] or mov['collected'] or mov['watched']):
+            mov['watchlist'] = True
+        if rnd.random() < 0.6:
+            mov['tags'] = rnd.sample(TAGS, rnd.randint(1, 3))
+        if mov['collected'] and rnd.random() < 0.5:
+            mov['subtitles'] = ['eng', 'ita']
+        udata['movies']['tt%07d' % i] = mov
+    for i in range(size):
+        sid = str(70000 + i)
+        ser = {'name': 'N/A' if i % 4 == 0 else 'Series %s' % sid, 'watchlist': rnd.random() < 0.7,
+               'collected': {}, 'watched': {}}
+        if rnd.random() < 0.6:
+            ser['tags'] = rnd.sample(TAGS, rnd.randint(1, 3))
+        for sno in range(1, rnd.randint(1, 6) + 1):
+            episodes = range(1, rnd.randint(6, 13) + 1)
+            collected = [eno for eno in episodes if rnd.random() < 0.4]
+            watched = [eno for eno in episodes if rnd.random() < 0.5]
+            if collected:
+                ser['collected'][str(sno)] = dict((str(eno), ['eng'] if rnd.random() < 0.3 else [])
+                                                  for eno in collected)
+            if watched:
+                ser['watched'][str(sno)] = watched
+        if not (ser['watchlist'] or ser['collected'] or ser['watched']):
+            ser['watchlist'] = True
+        udata['series'][sid] = ser
+    return udata
+
+
+def make_diffs(rnd, size, files=4):
+    """Returns files lists of time-ordered diff lines, size / 10 changes in total."""
+    diffs = []
+    ts = 1431093328971
+    for n in range(files):
+        lines = []
+        for i in range(size // 10 // files):
+            ts += rnd.randint(1, 1000)
+            if rnd.random() < 0.3:
+                tid = 'tt%07d' % rnd.randrange(size // 2 + size // 20)
+                fld = rnd.choice(['watchlist', 'collected', 'watched', 'tags', 'rating'])
+                typ = 'movie'
+            else:
+                tid = str(70000 + rnd.randrange(size + size // 10))
+                fld = rnd.choice(['watchlist', 'tags', 'rating', 'collected', 'watched', 'subtitles'])
+                if fld in ['collected', 'watched', 'subtitles']:
+                    tid += '.%d.%d' % (rnd.randint(1, 6), rnd.randint(1, 13))
+                typ = 'series'
+            if fld == 'tags':
+                val = ','.join(rnd.sample(TAGS, 2))
+            elif fld == 'subtitles':
+                val = 'eng,ita'
+            elif fld == 'rating':
+                val = str(rnd.randint(0, 5))
+            else:
+                val = rnd.choice(['true', 'true', 'false'])
+            lines.append('%d|%s|%s|%s|%s' % (ts, typ, tid, fld, val))
+        diffs.append(lines)
+    return diffs
+
+
+def sample_entries(rnd, udata, count):
+    """Returns count episode entries and count / 2 movie entries from the library (plus some unknown ones)."""
+    entries = []
+    sids = sorted(udata['series'])
+    for i in range(count):
+        entry = Entry()
+        entry['title'] = 'episode %d' % i
+        entry['url'] = 'http://localhost/%d' % i
+        entry['tvdb_id'] = int(rnd.choice(sids)) if rnd.random() < 0.9 else 1
+        entry['series_season'] = rnd.randint(1, 6)
+        entry['series_episode'] = rnd.randint(1, 13)
+        entries.append(entry)
+    mids = sorted(udata['movies'])
+    for i in range(count // 2):
+        entry = Entry()
+        entry['title'] = 'movie %d' % i
+        entry['url'] = 'http://localhost/m%d' % i
+        entry['imdb_id'] = rnd.choice(mids) if rnd.random() < 0.9 else 'tt9999999'
+        entries.append(entry)
+    return entries
+
+
+class Library(object):
+    """A synthetic uoccin folder, restored from the generated files before each run."""
+
+    def __init__(self, base, size, seed):
+        rnd = random.Random(seed)
+        self.size = size
+        self.folder = os.path.join(base, 'uoccin')
+        self.config_base = os.path.join(base, 'config')
+        self.master = os.path.join(base, 'master.json')
+        os.makedirs(base)
+        self.udata = make_library(rnd, size)
+        with open(self.master, 'w') as f:
+            json.dump(self.udata, f)
+        self.diffs = make_diffs(rnd, size)
+        self.entries = sample_entries(rnd, self.udata, 1000)
+
+    def restore(self):
+        for path in [self.folder, self.config_base]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+        for device in [UUID, 'phone', 'tablet']:
+            os.makedirs(os.path.join(self.folder, 'device.' + device))
+        shutil.copy(self.master, uoccin_data.uoccin_file(self.folder))
+        uoccin_data.invalidate_uoccin_data(self.folder)
+        uoccin_emit.NameCache._instances.clear()
+
+    def write_diffs(self):
+        filenames = []
+        for n, lines in enumerate(self.diffs):
+            filename = os.path.join(self.folder, 'device.%s' % UUID, '%d.phone%d.diff' % (n, n))
+            with open(filename, 'w') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            filenames.append(filename)
+        return filenames
+
+
+def bench_process(lib, backend):
+    files = lib.write_diffs()
+    task = fake_task(lib.config_base)
+    processor = uoccin_processors.UoccinProcess()
+    processor.reset(lib.folder, db_file=uoccin_processors.uoccin_db_file(task) if backend == 'sqlite' else None,
+                    lock_dir=lib.config_base)
+    for filename in files:
+        processor.load(filename)
+    return lambda: processor.process()
+
+
+def bench_lookup(lib, backend):
+    lookup = create_plugin(uoccin_lookup.UoccinLookup, 'uoccin_lookup')
+    task = fake_task(lib.config_base, lib.entries)
+    return lambda: lookup.on_task_metainfo(task, {'path': lib.folder, 'backend': backend})
+
+
+def bench_emit(lib, backend, typ, **options):
+    emit = create_plugin(uoccin_emit.UoccinEmit, 'uoccin_emit')
+    task = fake_task(lib.config_base)
+    config = {'path': lib.folder, 'type': typ, 'check_tags': 'any', 'ep_flags': 'watched', 'backend': backend,
+              'names_ttl': '7 days', 'lookup_threads': 8, 'compact_json': False, 'stream': False}
+    config.update(options)
+    return lambda: len(list(emit.on_task_input(task, config)))
+
+
+def bench_writer(lib, backend, cls, name):
+    writer = create_plugin(cls, name)
+    task = fake_task(lib.config_base, [entry for entry in lib.entries if 'tvdb_id' in entry])
+    config = {'uuid': UUID, 'path': lib.folder, 'compact_json': False, 'checkpoint_every': 0, 'backend': backend,
+              'max_buffer': 1000, 'compression': 'none'}
+
+    def run():
+        writer.on_task_start(task, config)
+        writer.on_task_output(task, config)
+        writer.on_task_exit(task, config)
+    return run
+
+
+BENCHMARKS = [
+    ('process', bench_process, {}),
+    ('lookup', bench_lookup, {}),
+    ('emit_movies', bench_emit, {'typ': 'movies'}),
+    ('emit_series', bench_emit, {'typ': 'series'}),
+    ('emit_series_tags', bench_emit, {'typ': 'series', 'tags': ['hires', 'netflix'], 'check_tags': 'none'}),
+    ('emit_episodes', bench_emit, {'typ': 'episodes'}),
+    ('writer_watched', bench_writer, {'cls': uoccin_processors.UoccinSeenAdd, 'name': 'uoccin_watched_true'}),
+    ('writer_collection', bench_writer, {'cls': uoccin_processors.UoccinCollAdd, 'name': 'uoccin_collection_add'}),
+]
+
+
+def run_benchmark(lib, backend, factory, options, repeat):
+    """Returns the timings (in seconds) of repeat runs, each on a freshly restored library."""
+    timings = []
+    for i in range(repeat):
+        lib.restore()
+        func = factory(lib, backend, **options)
+        started = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - started)
+    return timings
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the uoccin plugins on synthetic libraries.')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='library sizes (number of series)')
+    parser.add_argument('--backends', default='json,sqlite', help='backends to benchmark')
+    parser.add_argument('--only', help='comma separated benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs for each benchmark')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'bench_output.json'))
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    install_stubs()
+    only = args.only.split(',') if args.only else None
+    results = {'revision': git_revision(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'repeat': args.repeat, 'seed': args.seed, 'results': {}}
+    base = tempfile.mkdtemp(prefix='uoccin_bench.')
+    try:
+        for size in [int(n) for n in args.sizes.split(',')]:
+            lib = Library(os.path.join(base, str(size)), size, args.seed)
+            for backend in args.backends.split(','):
+                for name, factory, options in BENCHMARKS:
+                    if only and name not in only:
+                        continue
+                    timings = run_benchmark(lib, backend, factory, options, args.repeat)
+                    key = '%s/%s/%d' % (name, backend, size)
+                    results['results'][key] = {'min': min(timings), 'max': max(timings),
+                                               'median': sorted(timings)[len(timings) // 2], 'runs': timings}
+                    print('%-40s %10.4f s' % (key, min(timings)))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
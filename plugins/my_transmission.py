@@ -1,12 +1,21 @@
 from __future__ import unicode_literals, division, absolute_import
 from builtins import *  # noqa pylint: disable=unused-import, redefined-builtin
 from future.moves.urllib.parse import urlparse
+from future.moves.http.client import HTTPConnection, HTTPSConnection, HTTPException
 from future.utils import text_to_native_str
 
 import os
 import logging
 import base64
+import binascii
+import json
 import re
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 from netrc import netrc, NetrcParseError
@@ -26,14 +35,325 @@ try:
     import transmissionrpc
     from transmissionrpc import TransmissionError
     from transmissionrpc import HTTPHandlerError
+    from transmissionrpc.httphandler import HTTPHandler
 except ImportError:
     # If transmissionrpc is not found, errors will be shown later
-    pass
+    HTTPHandler = object
 
 log = logging.getLogger('transmission')
 
+# rpc clients shared by all the tasks (and plugins), see get_rpc_client
+_clients = {}
+_clients_lock = threading.Lock()
+# a pooled client unused for longer than this is checked with a session-get before being handed out again
+HEALTH_CHECK_INTERVAL = 60
+# torrent lists kept by my_from_transmission, one per daemon, see TorrentCache
+_torrent_caches = {}
+_torrent_caches_lock = threading.Lock()
+# transmission reports as recently active (and removed) the torrents changed in the last 60 seconds, a sync older
+# than this (with some margin for the request time) could miss changes and is followed by a full one
+RECENTLY_ACTIVE_WINDOW = 50
+
+
+def client_key(config):
+    return config['host'], config['port'], config.get('username')
+
+
+def get_recently_active(client, fields):
+    """Returns (torrents, removed ids) for a torrent-get of the recently active torrents. transmissionrpc can't ask
+    for them, and drops the removed ids from the response, so the request goes through its (private) http query:
+    raises PluginError if that's not there anymore, or doesn't work as expected."""
+    http_query = getattr(client, '_http_query', None)
+    if http_query is None:
+        raise plugin.PluginError(
+            'this transmissionrpc version (%s) is not supported by incremental: yes, disable it'
+            % transmissionrpc.__version__
+        )
+    query = json.dumps(
+        {
+            'method': 'torrent-get',
+            'arguments': {'fields': fields, 'ids': 'recently-active'},
+        }
+    )
+    try:
+        data = json.loads(http_query(query))
+        if data.get('result') != 'success':
+            raise TransmissionError('Query failed with result "%s".' % data.get('result'))
+        arguments = data['arguments']
+        torrents = [transmissionrpc.Torrent(client, item) for item in arguments['torrents']]
+        return torrents, arguments.get('removed', [])
+    except (TypeError, ValueError, KeyError, AttributeError) as e:
+        raise plugin.PluginError(
+            'unexpected recently-active response with transmissionrpc %s (%s), disable incremental'
+            % (transmissionrpc.__version__, e)
+        )
+
+
+class KeepAliveHTTPHandler(HTTPHandler):
+    """transmissionrpc http handler keeping its connections open between the requests (the default one opens a new
+    connection for each of them). Idle connections are kept in a stack, so the client can be used by several threads
+    at once."""
+
+    def __init__(self):
+        self.auth = None
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def set_authentication(self, uri, login, password):
+        # transmission uses basic authentication, send it right away instead of waiting for the 401
+        credentials = ('%s:%s' % (login, password)).encode('utf-8')
+        self.auth = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+    def connect(self, url, timeout):
+        with self.lock:
+            if self.idle:
+                conn = self.idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        conn_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+        return conn_class(url.hostname, url.port, timeout=timeout), False
+
+    def release(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, url, query, headers, timeout):
+        parsed = urlparse(url)
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        if self.auth:
+            headers['Authorization'] = self.auth
+        while True:
+            conn, reused = self.connect(parsed, timeout)
+            try:
+                conn.request('POST', parsed.path or '/', query.encode('utf-8'), headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, HTTPException) as error:
+                conn.close()
+                if isinstance(error, socket.timeout):
+                    raise HTTPHandlerError(url, 110, 'timed out')
+                if reused:
+                    # the daemon closed the idle connection meanwhile, retry on a new one
+                    continue
+                raise HTTPHandlerError(url, getattr(error, 'errno', None), str(error))
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        if response.status != 200:
+            raise HTTPHandlerError(url, response.status, response.reason, dict(response.getheaders()), data)
+        return data.decode('utf-8')
+
+
+class PooledClient(object):
+    """A client of the pool, with the password it was created with and the last time it was used."""
+
+    def __init__(self, client, password):
+        self.client = client
+        self.password = password
+        self.last_used = time.time()
+
+    def healthy(self):
+        if time.time() - self.last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            # the session id is renegotiated by transmissionrpc if the daemon was restarted (409)
+            self.client.get_session()
+        except TransmissionError as e:
+            log.debug('pooled transmission client is not usable anymore (%s), reconnecting' % e)
+            return False
+        return True
+
+    def close(self):
+        handler = self.client.http_handler
+        if isinstance(handler, KeepAliveHTTPHandler):
+            handler.close()
+
+
+class TorrentCache(object):
+    """The torrents of a daemon, as last seen by my_from_transmission. It's seeded with a full torrent-get, then
+    only the recently active torrents are fetched and merged, and the removed ones dropped. A full fetch is done again
+    every full_sync, when more fields are needed, when the last sync is too old to trust the recently active list
+    and when the daemon was restarted (the torrent ids may have changed)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.torrents = {}
+        self.fields = []
+        self.session_id = None
+        self.last_full = 0
+        self.last_sync = 0
+
+    def needs_full_sync(self, client, fields, full_sync):
+        now = time.time()
+        return (
+            any(f not in self.fields for f in fields)
+            or client.session_id != self.session_id
+            or now - self.last_sync > RECENTLY_ACTIVE_WINDOW
+            or now - self.last_full > full_sync
+        )
+
+    def sync(self, client, fields, full_sync):
+        """Returns the torrents (sorted by id) with at least the given fields, full_sync is in seconds."""
+        with self.lock:
+            now = time.time()
+            if not self.needs_full_sync(client, fields, full_sync) and self.merge_recently_active(client):
+                self.last_sync = now
+            else:
+                fields = self.fields + [f for f in fields if f not in self.fields]
+                torrents = client.get_torrents(arguments=fields)
+                self.torrents = dict((torrent.id, torrent) for torrent in torrents)
+                self.fields = fields
+                self.session_id = client.session_id
+                self.last_full = self.last_sync = now
+                log.debug('full sync: %d torrents' % len(self.torrents))
+            return [self.torrents[torrent_id] for torrent_id in sorted(self.torrents)]
+
+    def merge_recently_active(self, client):
+        """Merges the recently active torrents, returns False if the daemon was restarted meanwhile."""
+        torrents, removed = get_recently_active(client, self.fields)
+        if client.session_id != self.session_id:
+            # a new session id was negotiated, the ids in the cache may not be valid anymore
+            return False
+        for torrent in torrents:
+            self.torrents[torrent.id] = torrent
+        for torrent_id in removed:
+            self.torrents.pop(torrent_id, None)
+        log.debug('incremental sync: %d torrents updated, %d removed' % (len(torrents), len(removed)))
+        return True
+
+
+# info hash in a magnet link, hex or base32 encoded
+BTIH_RE = re.compile(r'xt=urn:btih:([0-9a-f]{40}|[a-z2-7]{32})', re.IGNORECASE)
+
+
+def entry_hash(entry):
+    """Returns the lowercased info hash of the torrent of an entry: the torrent_info_hash field, or the hash of the
+    torrent file or of the magnet link. None if there's none."""
+    if entry.get('torrent_info_hash'):
+        return entry['torrent_info_hash'].lower()
+    info_hash = getattr(entry.get('torrent'), 'info_hash', None)
+    if info_hash:
+        return info_hash.lower()
+    match = BTIH_RE.search(entry.get('url', ''))
+    if not match:
+        return None
+    info_hash = match.group(1)
+    if len(info_hash) == 32:
+        info_hash = binascii.hexlify(base64.b32decode(info_hash.upper())).decode('ascii')
+    return info_hash.lower()
+
+
+class TorrentIndex(object):
+    """The session torrents by lowercased info hash and by id, so every entry is matched in O(1). Shared by the
+    workers of on_task_output, which add (remove) the torrents they add (remove)."""
+
+    def __init__(self, torrents):
+        self.lock = threading.Lock()
+        self.by_hash = dict((t.hashString.lower(), t) for t in torrents)
+        self.by_id = dict((t.id, t) for t in torrents)
+
+    def find(self, entry):
+        with self.lock:
+            return self.by_hash.get(entry_hash(entry)) or self.by_id.get(entry.get('transmission_id'))
+
+    def key(self, entry):
+        """Returns what identifies the torrent of the entry: its info hash if known (from the entry or, by id,
+        from the session torrents), the url otherwise."""
+        info_hash = entry_hash(entry)
+        if info_hash:
+            return info_hash
+        with self.lock:
+            torrent = self.by_id.get(entry.get('transmission_id'))
+        return torrent.hashString.lower() if torrent else entry['url']
+
+    def add(self, torrent):
+        with self.lock:
+            self.by_hash[torrent.hashString.lower()] = torrent
+            self.by_id[torrent.id] = torrent
+
+    def remove(self, torrent):
+        with self.lock:
+            self.by_hash.pop(torrent.hashString.lower(), None)
+            self.by_id.pop(torrent.id, None)
+
+
+class EntryLog(object):
+    """Keeps the log messages (and the failure) of an entry processed by a worker of on_task_output, so they're
+    logged in the entries order whatever the order the workers run in."""
+
+    def __init__(self):
+        self.records = []
+        self.failure = None
+
+    def log(self, level, msg, *args, **kwargs):
+        if kwargs.get('exc_info') is True:
+            kwargs['exc_info'] = sys.exc_info()
+        self.records.append((level, msg, args, kwargs))
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def fail(self, msg):
+        self.failure = msg
+
+    def flush(self, entry):
+        for level, msg, args, kwargs in self.records:
+            log.log(level, msg, *args, **kwargs)
+        self.records = []
+        if self.failure:
+            entry.fail(self.failure)
+
 
 class TransmissionBase(object):
+    # torrent-get fields used to build the my_from_transmission entries and to check the seed limits (the file
+    # lists are fetched apart, see get_files)
+    entry_fields = [
+        'id',
+        'name',
+        'hashString',
+        'totalSize',
+        'comment',
+        'downloadDir',
+        'isFinished',
+        'isPrivate',
+        'uploadRatio',
+        'status',
+        'activityDate',
+        'addedDate',
+        'doneDate',
+        'startDate',
+        'bandwidthPriority',
+        'sizeWhenDone',
+        'leftUntilDone',
+        'secondsDownloading',
+        'secondsSeeding',
+        'trackers',
+        'seedRatioMode',
+        'seedRatioLimit',
+        'seedIdleMode',
+        'seedIdleLimit',
+    ]
+
     def __init__(self):
         self.client = None
         self.opener = None
@@ -61,7 +381,9 @@ class TransmissionBase(object):
         user, password = config.get('username'), config.get('password')
 
         try:
-            cli = transmissionrpc.Client(config['host'], config['port'], user, password)
+            cli = transmissionrpc.Client(
+                config['host'], config['port'], user, password, http_handler=KeepAliveHTTPHandler()
+            )
         except TransmissionError as e:
             if isinstance(e.original, HTTPHandlerError):
                 if e.original.code == 111:
@@ -82,11 +404,41 @@ class TransmissionBase(object):
                 raise plugin.PluginError("Error connecting to transmission: %s" % e.message)
         return cli
 
-    def torrent_info(self, torrent, config):
+    def get_rpc_client(self, config):
+        """Returns the shared client for the host, port and username in config, creating it (or replacing it, if the
+        password changed or the client doesn't respond anymore) as needed. Sharing it saves the connection, the
+        session id negotiation and the authentication at every task."""
+        key = client_key(config)
+        password = config.get('password')
+        with _clients_lock:
+            pooled = _clients.get(key)
+        if pooled is not None and (pooled.password != password or not pooled.healthy()):
+            pooled.close()
+            pooled = None
+        if pooled is None:
+            pooled = PooledClient(self.create_rpc_client(config), password)
+            with _clients_lock:
+                _clients[key] = pooled
+        pooled.last_used = time.time()
+        return pooled.client
+
+    def get_files(self, torrents):
+        """Returns the files of all the given torrents ({id: {file id: file}}, as client.get_files) with a single
+        torrent-get call, so the torrents can be listed without their (big) file lists."""
+        ids = [torrent.id for torrent in torrents]
+        if not ids:
+            return {}
+        return self.client.get_files(ids)
+
+    def torrent_info(self, torrent, config, files=None):
+        """Returns (done, main file location) for the torrent, files is its file list as returned by get_files
+        (read from the torrent fields if not given)."""
         done = torrent.totalSize > 0
         vloc = None
         best = None
-        for t in torrent.files().items():
+        if files is None:
+            files = torrent.files()
+        for t in files.items():
             tf = t[1]
             if tf['selected']:
                 if tf['size'] <= 0 or tf['completed'] < tf['size']:
@@ -140,14 +492,14 @@ class TransmissionBase(object):
                 'Transmissionrpc module version 0.11 or higher required, please upgrade', log
             )
 
-        # Mark rpc client for garbage collector so every task can start
-        # a fresh new according its own config - fix to bug #2804
+        # Forget the client of the previous task so every task gets the one for its own config (fix to bug #2804),
+        # the connection itself is kept in the pool (see get_rpc_client)
         self.client = None
         config = self.prepare_config(config)
         if config['enabled']:
             if task.options.test:
                 log.info('Trying to connect to transmission...')
-                self.client = self.create_rpc_client(config)
+                self.client = self.get_rpc_client(config)
                 if self.client:
                     log.info('Successfully connected to transmission.')
                 else:
@@ -155,6 +507,27 @@ class TransmissionBase(object):
 
 
 class PluginTransmissionInput(TransmissionBase):
+    """
+    Create an entry for each torrent in transmission.
+
+    Only the torrent fields needed for the entries are requested to the daemon. With verbose the entries also get the
+    raw value of the listed RPC fields (all of them with verbose: yes) as transmission_<field>.
+
+    With incremental: yes the torrent list is kept between the runs and only the recently active torrents are
+    requested, but transmission only reports the changes of the last minute: that only helps tasks running more often
+    than that (daemon mode with a short interval, or triggered by other tasks), the other runs fetch the whole list
+    anyway. The whole list is also fetched again every full_sync (default 1 hour). Off by default.
+
+    Example::
+
+      my_from_transmission:
+        host: localhost
+        port: 9091
+        only_complete: yes
+        verbose: [ 'eta', 'rateDownload' ]
+        incremental: yes
+        full_sync: 30 minutes
+    """
 
     schema = {
         'anyOf': [
@@ -169,6 +542,11 @@ class PluginTransmissionInput(TransmissionBase):
                     'password': {'type': 'string'},
                     'enabled': {'type': 'boolean'},
                     'only_complete': {'type': 'boolean'},
+                    'verbose': {
+                        'oneOf': [{'type': 'boolean'}, one_or_more({'type': 'string'})]
+                    },
+                    'incremental': {'type': 'boolean'},
+                    'full_sync': {'type': 'string', 'format': 'interval'},
                 },
                 'additionalProperties': False,
             },
@@ -178,15 +556,41 @@ class PluginTransmissionInput(TransmissionBase):
     def prepare_config(self, config):
         config = TransmissionBase.prepare_config(self, config)
         config.setdefault('only_complete', False)
+        config.setdefault('verbose', False)
+        config.setdefault('incremental', False)
+        config.setdefault('full_sync', '1 hour')
+        if not isinstance(config['verbose'], (bool, list)):
+            config['verbose'] = [config['verbose']]
         return config
 
+    def verbose_fields(self, config):
+        if config['verbose'] is True:
+            return list(self.client.torrent_get_arguments)
+        return config['verbose'] or []
+
+    def torrent_fields(self, config):
+        """Returns the torrent-get fields needed for the configured entries."""
+        fields = list(self.entry_fields)
+        # Location of torrent is only valid if transmission is on same machine as flexget
+        if config['host'] in ('localhost', '127.0.0.1'):
+            fields = fields + ['torrentFile']
+        return fields + [f for f in self.verbose_fields(config) if f not in fields]
+
+    def list_torrents(self, config):
+        fields = self.torrent_fields(config)
+        if not config['incremental']:
+            return self.client.get_torrents(arguments=fields)
+        with _torrent_caches_lock:
+            cache = _torrent_caches.setdefault(client_key(config), TorrentCache())
+        return cache.sync(self.client, fields, parse_timedelta(config['full_sync']).total_seconds())
+
     def on_task_input(self, task, config):
         config = self.prepare_config(config)
         if not config['enabled']:
             return
 
         if not self.client:
-            self.client = self.create_rpc_client(config)
+            self.client = self.get_rpc_client(config)
         entries = []
 
         # Hack/Workaround for http://flexget.com/ticket/2002
@@ -198,12 +602,19 @@ class PluginTransmissionInput(TransmissionBase):
 
         session = self.client.get_session()
 
-        for torrent in self.client.get_torrents():
+        verbose_fields = self.verbose_fields(config)
+        torrents = []
+        for torrent in self.list_torrents(config):
             seed_ratio_ok, idle_limit_ok = self.check_seed_limits(torrent, session)
             if config['only_complete'] and not (
                 seed_ratio_ok and idle_limit_ok and torrent.progress == 100
             ):
                 continue
+            torrents.append((torrent, seed_ratio_ok, idle_limit_ok))
+        # The file lists are only needed for the completed torrents, fetched at once
+        files = self.get_files([t for t, dummy, dummy in torrents if t.progress == 100])
+
+        for torrent, seed_ratio_ok, idle_limit_ok in torrents:
             entry = Entry(
                 title=torrent.name,
                 url='',
@@ -237,6 +648,11 @@ class PluginTransmissionInput(TransmissionBase):
                     log.debug(
                         'error when requesting transmissionrpc attribute %s', attr, exc_info=True
                     )
+            for field in verbose_fields:
+                try:
+                    entry['transmission_' + field] = getattr(torrent, field)
+                except Exception:
+                    log.debug('transmission field %s not available', field)
             entry['transmission_trackers'] = [t['announce'] for t in torrent.trackers]
             entry['transmission_seed_ratio_ok'] = seed_ratio_ok
             entry['transmission_idle_limit_ok'] = idle_limit_ok
@@ -245,7 +661,7 @@ class PluginTransmissionInput(TransmissionBase):
                 entry['transmission_date_done'] = datetime.fromtimestamp(
                     max(torrent.addedDate, torrent.doneDate)
                 )
-                dummy, bff = self.torrent_info(torrent, config)
+                dummy, bff = self.torrent_info(torrent, config, files.get(torrent.id, {}))
                 if bff:
                     entry['bigfile_location'] = bff
             entries.append(entry)
@@ -272,6 +688,10 @@ class PluginTransmission(TransmissionBase):
         host: localhost
         port: 9091
         enabled: yes
+        workers: 4
+
+    The accepted entries are sent to transmission by up to workers threads at once (the entries of the same torrent
+    by the same one), their messages are logged in the entries order anyway.
     """
 
     schema = {
@@ -307,6 +727,7 @@ class PluginTransmission(TransmissionBase):
                     'skip_files': one_or_more({'type': 'string'}),
                     'rename_like_files': {'type': 'boolean'},
                     'queue_position': {'type': 'integer'},
+                    'workers': {'type': 'integer', 'minimum': 1},
                 },
                 'additionalProperties': False,
             },
@@ -322,6 +743,7 @@ class PluginTransmission(TransmissionBase):
         config.setdefault('include_subs', False)
         config.setdefault('rename_like_files', False)
         config.setdefault('include_files', [])
+        config.setdefault('workers', 4)
         return config
 
     @plugin.priority(120)
@@ -357,273 +779,301 @@ class PluginTransmission(TransmissionBase):
         if not task.accepted:
             return
         if self.client is None:
-            self.client = self.create_rpc_client(config)
+            self.client = self.get_rpc_client(config)
             if self.client:
                 log.debug('Successfully connected to transmission.')
             else:
                 raise plugin.PluginError("Couldn't connect to transmission.")
-        session_torrents = self.client.get_torrents()
-        for entry in task.accepted:
-            if task.options.test:
+        torrent_index = TorrentIndex(self.client.get_torrents())
+        if task.options.test:
+            for entry in task.accepted:
                 log.info('Would %s %s in transmission.', config['action'], entry['title'])
-                continue
-            # Compile user options into appropriate dict
-            options = self._make_torrent_options_dict(config, entry)
-            torrent_info = None
-            for t in session_torrents:
-                if t.hashString.lower() == entry.get(
-                    'torrent_info_hash', ''
-                ).lower() or t.id == entry.get('transmission_id'):
-                    torrent_info = t
-                    log.debug(
-                        'Found %s already loaded in transmission as %s',
-                        entry['title'],
-                        torrent_info.name,
+            return
+        entries = list(task.accepted)
+        # Compile user options into appropriate dict
+        options = [self._make_torrent_options_dict(config, entry) for entry in entries]
+        # The entries of the same torrent go to the same worker, in order, so it's never added (or removed) twice
+        groups = OrderedDict()
+        for i, entry in enumerate(entries):
+            groups.setdefault(torrent_index.key(entry), []).append(i)
+        logs = [EntryLog() for _ in entries]
+
+        def process_group(indexes):
+            for i in indexes:
+                try:
+                    self.process_entry(task, config, entries[i], options[i], torrent_index, logs[i])
+                except Exception as e:
+                    # one broken entry doesn't stop the others
+                    msg = 'Error trying to %s %s: %s' % (config['action'], entries[i]['title'], e)
+                    logs[i].debug('Unexpected error', exc_info=True)
+                    logs[i].error(msg)
+                    logs[i].fail(msg)
+
+        with ThreadPoolExecutor(max_workers=min(config['workers'], len(groups))) as executor:
+            futures = {}
+            for indexes in groups.values():
+                future = executor.submit(process_group, indexes)
+                for i in indexes:
+                    futures[i] = future
+            # log in the entries order, as soon as each one is done
+            for i, entry in enumerate(entries):
+                futures[i].result()
+                logs[i].flush(entry)
+
+    def process_entry(self, task, config, entry, options, torrent_index, elog):
+        """Adds (or removes, pauses...) the torrent of an entry, logging to elog (see EntryLog). Runs in the workers of
+        on_task_output."""
+        torrent_info = torrent_index.find(entry)
+        if torrent_info:
+            elog.debug(
+                'Found %s already loaded in transmission as %s',
+                entry['title'],
+                torrent_info.name,
+            )
+
+        if not torrent_info:
+            if config['action'] != 'add':
+                elog.warning(
+                    'Cannot %s %s because it is not loaded in transmission.',
+                    config['action'],
+                    entry['title'],
+                )
+                return
+            downloaded = not entry['url'].startswith('magnet:')
+
+            # Check that file is downloaded
+            if downloaded and 'file' not in entry:
+                elog.fail('`file` field missing?')
+                return
+
+            # Verify the temp file exists
+            if downloaded and not os.path.exists(entry['file']):
+                tmp_path = os.path.join(task.manager.config_base, 'temp')
+                elog.debug('entry: %s', entry)
+                elog.debug('temp: %s', ', '.join(os.listdir(tmp_path)))
+                elog.fail("Downloaded temp file '%s' doesn't exist!?" % entry['file'])
+                return
+
+            try:
+                if downloaded:
+                    with open(entry['file'], 'rb') as f:
+                        filedump = base64.b64encode(f.read()).decode('utf-8')
+                    torrent_info = self.client.add_torrent(filedump, 30, **options['add'])
+                else:
+                    # we need to set paused to false so the magnetization begins immediately
+                    options['add']['paused'] = False
+                    torrent_info = self.client.add_torrent(
+                        entry['url'], timeout=30, **options['add']
                     )
-                    break
+            except TransmissionError as e:
+                elog.debug('TransmissionError', exc_info=True)
+                elog.debug('Failed options dict: %s', options['add'])
+                msg = 'Error adding {} to transmission. TransmissionError: {}'.format(
+                    entry['title'], e.message or 'N/A'
+                )
+                elog.error(msg)
+                elog.fail(msg)
+                return
+            elog.info('"%s" torrent added to transmission', entry['title'])
+            # The info returned by the add call is incomplete, refresh it
+            torrent_info = self.client.get_torrent(torrent_info.id)
+            torrent_index.add(torrent_info)
 
-            if not torrent_info:
-                if config['action'] != 'add':
-                    log.warning(
-                        'Cannot %s %s because it is not loaded in transmission.',
-                        config['action'],
+        try:
+            total_size = torrent_info.totalSize
+            main_id = None
+            find_main_file = (
+                options['post'].get('main_file_only') or 'content_filename' in options['post']
+            )
+            skip_files = options['post'].get('skip_files')
+            # We need to index the files if any of the following are defined
+            if find_main_file or skip_files:
+                file_list = self.client.get_files(torrent_info.id)[torrent_info.id]
+
+                if options['post'].get('magnetization_timeout', 0) > 0 and not file_list:
+                    elog.debug(
+                        'Waiting %d seconds for "%s" to magnetize',
+                        options['post']['magnetization_timeout'],
                         entry['title'],
                     )
-                    continue
-                downloaded = not entry['url'].startswith('magnet:')
+                    for _ in range(options['post']['magnetization_timeout']):
+                        sleep(1)
+                        file_list = self.client.get_files(torrent_info.id)[torrent_info.id]
+                        if file_list:
+                            total_size = self.client.get_torrent(
+                                torrent_info.id, ['id', 'totalSize']
+                            ).totalSize
+                            break
+                    else:
+                        elog.warning(
+                            '"%s" did not magnetize before the timeout elapsed, '
+                            'file list unavailable for processing.',
+                            entry['title'],
+                        )
 
-                # Check that file is downloaded
-                if downloaded and 'file' not in entry:
-                    entry.fail('`file` field missing?')
-                    continue
+                # Find files based on config
+                dl_list = []
+                skip_list = []
+                main_list = []
+                ext_list = ['*.srt', '*.sub', '*.idx', '*.ssa', '*.ass']
+
+                main_ratio = config['main_file_ratio']
+                if 'main_file_ratio' in options['post']:
+                    main_ratio = options['post']['main_file_ratio']
+
+                for f in file_list:
+                    # No need to set main_id if we're not going to need it
+                    if find_main_file and file_list[f]['size'] > total_size * main_ratio:
+                        main_id = f
+
+                    if 'include_files' in options['post']:
+                        if any(
+                            fnmatch(file_list[f]['name'], mask)
+                            for mask in options['post']['include_files']
+                        ):
+                            dl_list.append(f)
+                        elif options['post'].get('include_subs') and any(
+                            fnmatch(file_list[f]['name'], mask) for mask in ext_list
+                        ):
+                            dl_list.append(f)
+
+                    if skip_files:
+                        if any(fnmatch(file_list[f]['name'], mask) for mask in skip_files):
+                            skip_list.append(f)
+
+                if main_id is not None:
+                    # Look for files matching main ID title but with a different extension
+                    if options['post'].get('rename_like_files'):
+                        for f in file_list:
+                            # if this filename matches main filename we want to rename it as well
+                            fs = os.path.splitext(file_list[f]['name'])
+                            if fs[0] == os.path.splitext(file_list[main_id]['name'])[0]:
+                                main_list.append(f)
+                    else:
+                        main_list = [main_id]
 
-                # Verify the temp file exists
-                if downloaded and not os.path.exists(entry['file']):
-                    tmp_path = os.path.join(task.manager.config_base, 'temp')
-                    log.debug('entry: %s', entry)
-                    log.debug('temp: %s', ', '.join(os.listdir(tmp_path)))
-                    entry.fail("Downloaded temp file '%s' doesn't exist!?" % entry['file'])
-                    continue
+                    if main_id not in dl_list:
+                        dl_list.append(main_id)
+                elif find_main_file:
+                    elog.warning(
+                        'No files in "%s" are > %d%% of content size, no files renamed.',
+                        entry['title'],
+                        main_ratio * 100,
+                    )
 
-                try:
-                    if downloaded:
-                        with open(entry['file'], 'rb') as f:
-                            filedump = base64.b64encode(f.read()).decode('utf-8')
-                        torrent_info = self.client.add_torrent(filedump, 30, **options['add'])
+                # If we have a main file and want to rename it and associated files
+                if 'content_filename' in options['post'] and main_id is not None:
+                    if 'download_dir' not in options['add']:
+                        download_dir = self.client.get_session().download_dir
                     else:
-                        # we need to set paused to false so the magnetization begins immediately
-                        options['add']['paused'] = False
-                        torrent_info = self.client.add_torrent(
-                            entry['url'], timeout=30, **options['add']
-                        )
-                except TransmissionError as e:
-                    log.debug('TransmissionError', exc_info=True)
-                    log.debug('Failed options dict: %s', options['add'])
-                    msg = 'Error adding {} to transmission. TransmissionError: {}'.format(
-                        entry['title'], e.message or 'N/A'
-                    )
-                    log.error(msg)
-                    entry.fail(msg)
-                    continue
-                log.info('"%s" torrent added to transmission', entry['title'])
-                # The info returned by the add call is incomplete, refresh it
-                torrent_info = self.client.get_torrent(torrent_info.id)
+                        download_dir = options['add']['download_dir']
 
-            try:
-                total_size = torrent_info.totalSize
-                main_id = None
-                find_main_file = (
-                    options['post'].get('main_file_only') or 'content_filename' in options['post']
-                )
-                skip_files = options['post'].get('skip_files')
-                # We need to index the files if any of the following are defined
-                if find_main_file or skip_files:
-                    file_list = self.client.get_files(torrent_info.id)[torrent_info.id]
-
-                    if options['post'].get('magnetization_timeout', 0) > 0 and not file_list:
-                        log.debug(
-                            'Waiting %d seconds for "%s" to magnetize',
-                            options['post']['magnetization_timeout'],
-                            entry['title'],
-                        )
-                        for _ in range(options['post']['magnetization_timeout']):
-                            sleep(1)
-                            file_list = self.client.get_files(torrent_info.id)[torrent_info.id]
-                            if file_list:
-                                total_size = self.client.get_torrent(
-                                    torrent_info.id, ['id', 'totalSize']
-                                ).totalSize
-                                break
-                        else:
-                            log.warning(
-                                '"%s" did not magnetize before the timeout elapsed, '
-                                'file list unavailable for processing.',
-                                entry['title'],
+                    # Get new filename without ext
+                    file_ext = os.path.splitext(file_list[main_id]['name'])[1]
+                    file_path = os.path.dirname(
+                        os.path.join(download_dir, file_list[main_id]['name'])
+                    )
+                    filename = options['post']['content_filename']
+                    if config['host'] == 'localhost' or config['host'] == '127.0.0.1':
+                        counter = 1
+                        while os.path.exists(os.path.join(file_path, filename + file_ext)):
+                            # Try appending a (#) suffix till a unique filename is found
+                            filename = '%s(%s)' % (
+                                options['post']['content_filename'],
+                                counter,
                             )
-
-                    # Find files based on config
-                    dl_list = []
-                    skip_list = []
-                    main_list = []
-                    ext_list = ['*.srt', '*.sub', '*.idx', '*.ssa', '*.ass']
-
-                    main_ratio = config['main_file_ratio']
-                    if 'main_file_ratio' in options['post']:
-                        main_ratio = options['post']['main_file_ratio']
-
-                    for f in file_list:
-                        # No need to set main_id if we're not going to need it
-                        if find_main_file and file_list[f]['size'] > total_size * main_ratio:
-                            main_id = f
-
-                        if 'include_files' in options['post']:
-                            if any(
-                                fnmatch(file_list[f]['name'], mask)
-                                for mask in options['post']['include_files']
-                            ):
-                                dl_list.append(f)
-                            elif options['post'].get('include_subs') and any(
-                                fnmatch(file_list[f]['name'], mask) for mask in ext_list
-                            ):
-                                dl_list.append(f)
-
-                        if skip_files:
-                            if any(fnmatch(file_list[f]['name'], mask) for mask in skip_files):
-                                skip_list.append(f)
-
-                    if main_id is not None:
-                        # Look for files matching main ID title but with a different extension
-                        if options['post'].get('rename_like_files'):
-                            for f in file_list:
-                                # if this filename matches main filename we want to rename it as well
-                                fs = os.path.splitext(file_list[f]['name'])
-                                if fs[0] == os.path.splitext(file_list[main_id]['name'])[0]:
-                                    main_list.append(f)
-                        else:
-                            main_list = [main_id]
-
-                        if main_id not in dl_list:
-                            dl_list.append(main_id)
-                    elif find_main_file:
-                        log.warning(
-                            'No files in "%s" are > %d%% of content size, no files renamed.',
-                            entry['title'],
-                            main_ratio * 100,
+                            counter += 1
+                    else:
+                        elog.debug(
+                            'Cannot ensure content_filename is unique '
+                            'when adding to a remote transmission daemon.'
                         )
 
-                    # If we have a main file and want to rename it and associated files
-                    if 'content_filename' in options['post'] and main_id is not None:
-                        if 'download_dir' not in options['add']:
-                            download_dir = self.client.get_session().download_dir
-                        else:
-                            download_dir = options['add']['download_dir']
-
-                        # Get new filename without ext
-                        file_ext = os.path.splitext(file_list[main_id]['name'])[1]
-                        file_path = os.path.dirname(
-                            os.path.join(download_dir, file_list[main_id]['name'])
+                    for index in main_list:
+                        file_ext = os.path.splitext(file_list[index]['name'])[1]
+                        elog.debug(
+                            'File %s renamed to %s'
+                            % (file_list[index]['name'], filename + file_ext)
                         )
-                        filename = options['post']['content_filename']
-                        if config['host'] == 'localhost' or config['host'] == '127.0.0.1':
-                            counter = 1
-                            while os.path.exists(os.path.join(file_path, filename + file_ext)):
-                                # Try appending a (#) suffix till a unique filename is found
-                                filename = '%s(%s)' % (
-                                    options['post']['content_filename'],
-                                    counter,
-                                )
-                                counter += 1
-                        else:
-                            log.debug(
-                                'Cannot ensure content_filename is unique '
-                                'when adding to a remote transmission daemon.'
+                        # change to below when set_files will allow setting name, more efficient to have one call
+                        # fl[index]['name'] = os.path.basename(pathscrub(filename + file_ext).encode('utf-8'))
+                        try:
+                            self.client.rename_torrent_path(
+                                torrent_info.id,
+                                file_list[index]['name'],
+                                os.path.basename(str(pathscrub(filename + file_ext))),
                             )
-
-                        for index in main_list:
-                            file_ext = os.path.splitext(file_list[index]['name'])[1]
-                            log.debug(
-                                'File %s renamed to %s'
-                                % (file_list[index]['name'], filename + file_ext)
-                            )
-                            # change to below when set_files will allow setting name, more efficient to have one call
-                            # fl[index]['name'] = os.path.basename(pathscrub(filename + file_ext).encode('utf-8'))
-                            try:
-                                self.client.rename_torrent_path(
-                                    torrent_info.id,
-                                    file_list[index]['name'],
-                                    os.path.basename(str(pathscrub(filename + file_ext))),
-                                )
-                            except TransmissionError:
-                                log.error('content_filename only supported with transmission 2.8+')
-
-                    if options['post'].get('main_file_only') and main_id is not None:
-                        # Set Unwanted Files
-                        options['change']['files_unwanted'] = [
-                            x for x in file_list if x not in dl_list
+                        except TransmissionError:
+                            elog.error('content_filename only supported with transmission 2.8+')
+
+                if options['post'].get('main_file_only') and main_id is not None:
+                    # Set Unwanted Files
+                    options['change']['files_unwanted'] = [
+                        x for x in file_list if x not in dl_list
+                    ]
+                    options['change']['files_wanted'] = dl_list
+                    elog.debug(
+                        'Downloading %s of %s files in torrent.',
+                        len(options['change']['files_wanted']),
+                        len(file_list),
+                    )
+                elif (
+                    not options['post'].get('main_file_only') or main_id is None
+                ) and skip_files:
+                    # If no main file and we want to skip files
+
+                    if len(skip_list) >= len(file_list):
+                        elog.debug(
+                            'skip_files filter would cause no files to be downloaded; '
+                            'including all files in torrent.'
+                        )
+                    else:
+                        options['change']['files_unwanted'] = skip_list
+                        options['change']['files_wanted'] = [
+                            x for x in file_list if x not in skip_list
                         ]
-                        options['change']['files_wanted'] = dl_list
-                        log.debug(
+                        elog.debug(
                             'Downloading %s of %s files in torrent.',
                             len(options['change']['files_wanted']),
                             len(file_list),
                         )
-                    elif (
-                        not options['post'].get('main_file_only') or main_id is None
-                    ) and skip_files:
-                        # If no main file and we want to skip files
-
-                        if len(skip_list) >= len(file_list):
-                            log.debug(
-                                'skip_files filter would cause no files to be downloaded; '
-                                'including all files in torrent.'
-                            )
-                        else:
-                            options['change']['files_unwanted'] = skip_list
-                            options['change']['files_wanted'] = [
-                                x for x in file_list if x not in skip_list
-                            ]
-                            log.debug(
-                                'Downloading %s of %s files in torrent.',
-                                len(options['change']['files_wanted']),
-                                len(file_list),
-                            )
 
-                # Set any changed file properties
-                if list(options['change'].keys()):
-                    self.client.change_torrent(torrent_info.id, 30, **options['change'])
-
-                if config['action'] == 'add':
-                    # if add_paused was defined and set to False start the torrent;
-                    # prevents downloading data before we set what files we want
-                    start_paused = (
-                        options['post']['paused']
-                        if 'paused' in options['post']
-                        else not self.client.get_session().start_added_torrents
-                    )
-                    if start_paused:
-                        self.client.stop_torrent(torrent_info.id)
-                    else:
-                        self.client.start_torrent(torrent_info.id)
-                elif config['action'] in ('remove', 'purge'):
-                    self.client.remove_torrent(
-                        [torrent_info.id], delete_data=config['action'] == 'purge'
-                    )
-                    log.info('%sd %s from transmission', config['action'], torrent_info.name)
-                elif config['action'] == 'pause':
-                    self.client.stop_torrent([torrent_info.id])
-                    log.info('paused %s in transmission', torrent_info.name)
-                elif config['action'] == 'resume':
-                    self.client.start_torrent([torrent_info.id])
-                    log.info('resumed %s in transmission', torrent_info.name)
-
-            except TransmissionError as e:
-                log.debug('TransmissionError', exc_info=True)
-                log.debug('Failed options dict: %s', options)
-                msg = 'Error trying to {} {}, TransmissionError: {}'.format(
-                    config['action'], entry['title'], e.message or 'N/A'
+            # Set any changed file properties
+            if list(options['change'].keys()):
+                self.client.change_torrent(torrent_info.id, 30, **options['change'])
+
+            if config['action'] == 'add':
+                # if add_paused was defined and set to False start the torrent;
+                # prevents downloading data before we set what files we want
+                start_paused = (
+                    options['post']['paused']
+                    if 'paused' in options['post']
+                    else not self.client.get_session().start_added_torrents
                 )
-                log.error(msg)
-                continue
+                if start_paused:
+                    self.client.stop_torrent(torrent_info.id)
+                else:
+                    self.client.start_torrent(torrent_info.id)
+            elif config['action'] in ('remove', 'purge'):
+                self.client.remove_torrent(
+                    [torrent_info.id], delete_data=config['action'] == 'purge'
+                )
+                torrent_index.remove(torrent_info)
+                elog.info('%sd %s from transmission', config['action'], torrent_info.name)
+            elif config['action'] == 'pause':
+                self.client.stop_torrent([torrent_info.id])
+                elog.info('paused %s in transmission', torrent_info.name)
+            elif config['action'] == 'resume':
+                self.client.start_torrent([torrent_info.id])
+                elog.info('resumed %s in transmission', torrent_info.name)
+
+        except TransmissionError as e:
+            elog.debug('TransmissionError', exc_info=True)
+            elog.debug('Failed options dict: %s', options)
+            msg = 'Error trying to {} {}, TransmissionError: {}'.format(
+                config['action'], entry['title'], e.message or 'N/A'
+            )
+            elog.error(msg)
 
     def _make_torrent_options_dict(self, config, entry):
 
@@ -803,7 +1253,7 @@ class PluginTransmissionClean(TransmissionBase):
         if not config['enabled'] or task.options.learn:
             return
         if not self.client:
-            self.client = self.create_rpc_client(config)
+            self.client = self.get_rpc_client(config)
         tracker_re = re.compile(config['tracker'], re.IGNORECASE) if 'tracker' in config else None
         preserve_tracker_re = (
             re.compile(config['preserve_tracker'], re.IGNORECASE)
@@ -857,6 +1307,16 @@ class PluginTransmissionClean(TransmissionBase):
             self.client.remove_torrent(remove_ids, config.get('delete_files'))
 
 
+@event('manager.shutdown')
+def close_rpc_clients(manager):
+    with _clients_lock:
+        for pooled in _clients.values():
+            pooled.close()
+        _clients.clear()
+    with _torrent_caches_lock:
+        _torrent_caches.clear()
+
+
 @event('plugin.register')
 def register_plugin():
     # plugin.register(PluginTransmission, 'transmission', api_ver=2)
@@ -0,0 +1,590 @@
+from __future__ import unicode_literals, division, absolute_import
+from builtins import *  # pylint: disable=unused-import, redefined-builtin
+
+import copy
+import gzip
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from flexget import plugin
+from flexget.utils import json
+
+log = logging.getLogger('uoccin_data')
+
+# Materialized documents (uoccin.json snapshot + delta log tail), shared by all the uoccin plugins:
+# {path: {'sig': (mtime, size), 'offset': delta log bytes applied, 'seq': last sequence number applied,
+#         'udata': document, 'indexes': {name: index}}}
+# A document handed out is never modified: new delta log entries are applied to a copy which replaces it.
+_cache = {}
+_cache_lock = threading.Lock()
+cache_stats = {'hits': 0, 'misses': 0}
+
+# {path: lock} for the threads of this process, the other processes are kept out by the lock file
+_store_locks = {}
+
+
+def uoccin_file(path):
+    return os.path.join(path, 'uoccin.json')
+
+
+def delta_file(path):
+    return os.path.join(path, 'uoccin.delta')
+
+
+def seq_file(path):
+    """The last delta log sequence number folded in uoccin.json, kept apart since the Android app reads that."""
+    return os.path.join(path, 'uoccin.seq')
+
+
+def _read_seq(path):
+    try:
+        with open(seq_file(path), 'r') as f:
+            return int(f.read().strip() or 0)
+    except (IOError, OSError):
+        return 0
+    except ValueError:
+        log.warning('invalid sequence number in %s, ignored' % seq_file(path))
+        return 0
+
+
+def _write_seq(path, seq):
+    tmp = seq_file(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('%d\n' % seq)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, seq_file(path))
+
+
+DIFF_SUFFIXES = ('.diff', '.diff.gz', '.diff.zst')
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def is_diff_file(fn):
+    """Returns True for plain and compressed diff files."""
+    return fn.endswith(DIFF_SUFFIXES)
+
+
+def check_compression(compression):
+    """Raises PluginError if the diff files can't be written with the given compression."""
+    if compression == 'zstd' and zstandard is None:
+        raise plugin.PluginError('the zstandard package is required for compression: zstd')
+
+
+def _open_diff(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise plugin.PluginError('the zstandard package is required for %s' % filename)
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return io.open(filename, mode, encoding='utf-8')
+
+
+def read_diff(filename):
+    """Yields the lines of a diff file, plain or compressed (by extension), with absolute times. A time written as
+    +N is relative to the previous line (see write_diff)."""
+    last = 0
+    with _open_diff(filename, 'r') as f:
+        for line in f:
+            ts, sep, rest = line.partition('|')
+            try:
+                if ts.startswith('+'):
+                    last += int(ts[1:])
+                    line = '%d|%s' % (last, rest)
+                else:
+                    last = int(ts)
+            except ValueError:
+                pass
+            yield line
+
+
+def write_diff(filename, lines, compression='gzip'):
+    """Writes the (time-ordered) diff lines in filename compressed, with the times but the first delta-encoded.
+    Returns the name of the file, i.e. filename plus the compression extension."""
+    filename += COMPRESSED_SUFFIXES[compression]
+    last = None
+    with _open_diff(filename, 'w') as f:
+        for line in lines:
+            ts, sep, rest = line.partition('|')
+            try:
+                ts = int(ts)
+            except ValueError:
+                f.write(line)
+                continue
+            f.write('%s|%s' % (ts if last is None else '+%d' % (ts - last), rest))
+            last = ts
+    return filename
+
+
+def lock_file(path, lock_dir):
+    """The lock file for the library in path. It's kept in lock_dir (the FlexGet config folder), since the uoccin
+    folder is usually synced by a cloud client."""
+    key = os.path.normcase(os.path.abspath(path))
+    return os.path.join(lock_dir, 'uoccin.%s.lock' % hashlib.md5(key.encode('utf-8')).hexdigest()[:12])
+
+
+def _try_lock(f):
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _unlock(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def uoccin_lock(path, lock_dir, timeout=120):
+    """Advisory lock for the read-modify-write of the library in the given folder: only one thread of one process
+    (i.e. two FlexGet instances sharing the config folder lock_dir) at a time. Raises PluginError after timeout
+    seconds. Readers don't need it: the cached documents are never modified (see load_uoccin_data) and uoccin.json
+    is replaced atomically."""
+    key = os.path.normcase(os.path.abspath(path))
+    with _cache_lock:
+        state = _store_locks.setdefault(key, {'lock': threading.RLock(), 'depth': 0})
+    deadline = time.time() + timeout
+    if not state['lock'].acquire(timeout=timeout):
+        raise plugin.PluginError('timeout waiting for the lock on %s' % path)
+    try:
+        state['depth'] += 1
+        if state['depth'] > 1 or lock_dir is None:
+            # already held by this thread (or no lock folder given, the threads of this process only)
+            yield
+            return
+        filename = lock_file(path, lock_dir)
+        with open(filename, 'a+') as f:
+            while not _try_lock(f):
+                if time.time() > deadline:
+                    raise plugin.PluginError('timeout waiting for the lock on %s' % filename)
+                log.debug('waiting for the lock on %s' % filename)
+                time.sleep(0.5)
+            try:
+                yield
+            finally:
+                _unlock(f)
+    finally:
+        state['depth'] -= 1
+        state['lock'].release()
+
+
+def file_signature(ufile):
+    try:
+        st = os.stat(ufile)
+    except OSError:
+        return None
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
+
+
+def _read_uoccin_file(path):
+    """Returns (document, last sequence number folded in it) for the uoccin.json in the given folder."""
+    ufile = uoccin_file(path)
+    udata = {}
+    if os.path.exists(ufile):
+        try:
+            with open(ufile, 'r') as f:
+                udata = json.load(f)
+        except Exception as err:
+            raise plugin.PluginError('error reading %s: %s' % (ufile, err))
+    udata.setdefault('movies', {})
+    udata.setdefault('series', {})
+    # older versions kept the sequence number in the document itself
+    return udata, max(_read_seq(path), udata.pop('seq', 0))
+
+
+def set_field(item, field, value):
+    """Sets item[field] to value, returns True if that was a change."""
+    if field in item and item[field] == value:
+        return False
+    item[field] = value
+    return True
+
+
+# the fields accepted for each kind of target, mapped to themselves so the records all share the same strings
+MOVIE_FIELDS = dict((f, f) for f in ['watchlist', 'collected', 'watched', 'tags', 'subtitles', 'rating', 'name'])
+SERIES_FIELDS = dict((f, f) for f in ['watchlist', 'tags', 'rating', 'name'])
+EPISODE_FIELDS = dict((f, f) for f in ['collected', 'watched', 'subtitles'])
+FLAG_FIELDS = frozenset(['watchlist', 'collected', 'watched'])
+LIST_FIELDS = frozenset(['tags', 'subtitles'])
+
+LIST_SEP = re.compile(r',\s*')
+EPISODE_TARGET = re.compile(r'^(\d+)\.(\d+)\.(\d+)$')
+SERIES_TARGET = re.compile(r'^\d+$')
+
+# A parsed diff line: time, type ('movie' or 'series'), target (as in the line), movie/series id, season and episode
+# numbers (None unless the target is an episode), field and typed value (bool, int, tuple of strings or name)
+Change = namedtuple('Change', ['ts', 'typ', 'tid', 'sid', 'season', 'episode', 'field', 'value'])
+
+
+def make_change(ts, typ, tid, fld, val):
+    """Returns the Change for the given diff line fields, raises ValueError if they're not valid."""
+    season = episode = None
+    if typ == 'movie':
+        field = MOVIE_FIELDS.get(fld)
+        sid = tid
+        if not tid or '.' in tid:
+            raise ValueError('invalid movie target')
+    elif typ == 'series':
+        match = EPISODE_TARGET.match(tid)
+        if match:
+            sid, season, episode = match.group(1), int(match.group(2)), int(match.group(3))
+        elif SERIES_TARGET.match(tid):
+            sid = tid
+        else:
+            raise ValueError('invalid series target')
+        field = SERIES_FIELDS.get(fld)
+        if field is None and fld in EPISODE_FIELDS:
+            if episode is None:
+                raise ValueError('season and episode numbers are required')
+            field = EPISODE_FIELDS[fld]
+    else:
+        raise ValueError('invalid element type')
+    if field is None:
+        raise ValueError('invalid field')
+    if field in FLAG_FIELDS:
+        if val not in ('true', 'false'):
+            raise ValueError('invalid %s value' % field)
+        value = val == 'true'
+    elif field in LIST_FIELDS:
+        value = tuple(LIST_SEP.split(val))
+    elif field == 'rating':
+        try:
+            value = int(val)
+        except ValueError:
+            raise ValueError('invalid rating value')
+    else:
+        value = val
+    return Change(int(ts), typ, tid, sid, season, episode, field, value)
+
+
+def parse_change(line):
+    """Returns the Change for a diff line (time|type|target|field|value), raises ValueError if it's not valid."""
+    tmp = line.split('|', 4)
+    if len(tmp) < 5:
+        raise ValueError('missing fields')
+    try:
+        ts = int(tmp[0])
+    except ValueError:
+        raise ValueError('invalid time')
+    return make_change(ts, tmp[1], tmp[2], tmp[3], tmp[4])
+
+
+def format_value(change):
+    """Returns the value of the Change as written in the diff files."""
+    if change.field in FLAG_FIELDS:
+        return 'true' if change.value else 'false'
+    if change.field in LIST_FIELDS:
+        return ','.join(change.value)
+    return '%s' % change.value
+
+
+def format_change(change):
+    """Returns the diff line (without line terminator) for the Change."""
+    return '%d|%s|%s|%s|%s' % (change.ts, change.typ, change.tid, change.field, format_value(change))
+
+
+def apply_change(udata, typ, tid, fld, val, name=None):
+    """Applies a single change (type, target, field and value as found in the diff files) to the document.
+    If name is given it will be used as the movie/series name. Returns True if the document has changed.
+    Besides the fields used in the diff files, 'name' is accepted too (we use it in the delta log).
+    Raises ValueError if the change is not valid.
+    """
+    return apply_record(udata, make_change(0, typ, tid, fld, val), name)
+
+
+def apply_record(udata, change, name=None):
+    """Same as apply_change, for a Change already parsed."""
+    fld = change.field
+    val = change.value
+    if change.typ == 'movie':
+        tid = change.sid
+        # default
+        new = tid not in udata['movies']
+        mov = udata['movies'].setdefault(tid,
+                                         {'name': 'N/A', 'watchlist': False, 'collected': False, 'watched': False})
+        changed = set_field(mov, 'name', name) if name else False
+        # setting
+        if fld in LIST_FIELDS:
+            changed |= set_field(mov, fld, list(val))
+        else:
+            changed |= set_field(mov, fld, val)
+        # cleaning
+        if not (mov['watchlist'] or mov['collected'] or mov['watched']):
+            log.verbose('deleting unused section: movies\%s' % tid)
+            udata['movies'].pop(tid)
+            changed = not new
+        return changed
+    sid = change.sid
+    sno = str(change.season)
+    eno = change.episode
+    # default
+    new = sid not in udata['series']
+    ser = udata['series'].setdefault(sid, {'name': 'N/A', 'watchlist': False, 'collected': {}, 'watched': {}})
+    changed = set_field(ser, 'name', name) if name else False
+    # setting
+    if fld == 'tags':
+        changed |= set_field(ser, 'tags', list(val))
+    elif fld in SERIES_FIELDS:
+        changed |= set_field(ser, fld, val)
+    elif fld == 'collected':
+        season = ser['collected'].setdefault(sno, {})
+        if val:
+            changed |= str(eno) not in season
+            season.setdefault(str(eno), [])
+        else:
+            if str(eno) in season:
+                season.pop(str(eno))
+                changed = True
+            if not season:
+                log.verbose('deleting unused section: series\%s\collected\%s' % (sid, sno))
+                ser['collected'].pop(sno)
+    elif fld == 'subtitles':
+        changed |= set_field(ser['collected'].setdefault(sno, {}), str(eno), list(val))
+    elif fld == 'watched':
+        season = ser['watched'].setdefault(sno, [])
+        if val:
+            changed |= eno not in season
+            season = ser['watched'][sno] = list(set(season) | set([eno]))
+        elif eno in season:
+            season.remove(eno)
+            changed = True
+        season.sort()
+        if not season:
+            log.debug('deleting unused section: series\%s\watched\%s' % (sid, sno))
+            ser['watched'].pop(sno)
+    # cleaning
+    if not (ser['watchlist'] or ser['collected'] or ser['watched']):
+        log.debug('deleting unused section: series\%s' % sid)
+        udata['series'].pop(sid)
+        changed = not new
+    return changed
+
+
+def _detach(udata, change, owned):
+    """Replaces the movie/series the change is about with a deep copy (once, owned keeps track), so the change can be
+    applied to a shallow copy of a document without touching the original."""
+    section = udata['movies'] if change.typ == 'movie' else udata['series']
+    key = (change.typ, change.sid)
+    if key not in owned:
+        owned.add(key)
+        if change.sid in section:
+            section[change.sid] = copy.deepcopy(section[change.sid])
+
+
+def _apply_deltas(dfile, udata, offset=0, seq=0, owned=None):
+    """Applies to the document the delta log entries found after the given offset and with a sequence number greater
+    than seq (the ones not yet included in it). With owned (a set), udata must be a shallow copy of a shared document
+    (see load_uoccin_data) and the movies/series are copied before being changed.
+    Returns (offset of the first byte not applied, last sequence number applied): an incomplete last line is left
+    for the next time."""
+    if not os.path.exists(dfile):
+        return 0, seq
+    count = 0
+    with open(dfile, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                break
+            offset += len(raw)
+            tmp = raw.decode('utf-8').rstrip('\r\n').split('|', 1)
+            try:
+                line_seq = int(tmp[0])
+                change = parse_change(tmp[1])
+            except (IndexError, ValueError) as err:
+                log.warning('invalid line in %s: %s (%s)' % (dfile, raw, err))
+                continue
+            if line_seq <= seq:
+                continue
+            if owned is not None:
+                _detach(udata, change, owned)
+            apply_record(udata, change)
+            seq = line_seq
+            count += 1
+    if count:
+        log.debug('%d changes applied from %s' % (count, dfile))
+    return offset, seq
+
+
+def load_uoccin_data(path, cached=True):
+    """Returns the library stored in the given folder: the uoccin.json file plus the changes logged after it in the
+    uoccin.delta file (if any).
+
+    The materialized document is kept in a process-wide cache and reused as long as the uoccin.json mtime and size
+    don't change: new delta log entries are applied to a copy of it (sharing the movies/series not changed), which
+    replaces it in the cache. The dict returned is never modified afterwards, and must be considered read-only: use
+    cached=False to get a private copy to modify.
+    """
+    ufile = uoccin_file(path)
+    dfile = delta_file(path)
+    if not cached:
+        udata, seq = _read_uoccin_file(path)
+        _apply_deltas(dfile, udata, seq=seq)
+        return udata
+    key = os.path.normcase(os.path.abspath(ufile))
+    sig = file_signature(ufile)
+    dsig = file_signature(dfile)
+    dsize = dsig[1] if dsig else 0
+    with _cache_lock:
+        item = _cache.get(key)
+        if item is not None and item['sig'] == sig and item['offset'] <= dsize:
+            cache_stats['hits'] += 1
+            if item['offset'] < dsize:
+                udata = dict(item['udata'], movies=dict(item['udata']['movies']),
+                             series=dict(item['udata']['series']))
+                offset, seq = _apply_deltas(dfile, udata, item['offset'], item['seq'], set())
+                if offset != item['offset']:
+                    item = _cache[key] = {'sig': sig, 'offset': offset, 'seq': seq, 'udata': udata, 'indexes': {}}
+            log.debug('%s found in cache (hits: %d, misses: %d)' % (ufile, cache_stats['hits'], cache_stats['misses']))
+            return item['udata']
+        cache_stats['misses'] += 1
+        udata, seq = _read_uoccin_file(path)
+        offset, seq = _apply_deltas(dfile, udata, seq=seq)
+        _cache[key] = {'sig': sig, 'offset': offset, 'seq': seq, 'udata': udata, 'indexes': {}}
+        log.debug('%s loaded (hits: %d, misses: %d)' % (ufile, cache_stats['hits'], cache_stats['misses']))
+        return udata
+
+
+def get_uoccin_index(path, name, builder):
+    """Returns (udata, builder(udata)) for the (cached) document in the given folder, so the index always matches
+    the document it's used with. The index is cached along with the document and built again only when the document
+    changes, so it must be considered read-only too."""
+    udata = load_uoccin_data(path)
+    key = os.path.normcase(os.path.abspath(uoccin_file(path)))
+    with _cache_lock:
+        item = _cache.get(key)
+        if item is None or item['udata'] is not udata:
+            return udata, builder(udata)
+        if name not in item['indexes']:
+            item['indexes'][name] = builder(udata)
+            log.debug('%s index built for %s' % (name, uoccin_file(path)))
+        return udata, item['indexes'][name]
+
+
+def invalidate_uoccin_data(path):
+    """Drops the cached document for the given folder. Must be called by anyone writing the uoccin.json file."""
+    key = os.path.normcase(os.path.abspath(uoccin_file(path)))
+    with _cache_lock:
+        _cache.pop(key, None)
+
+
+def count_uoccin_deltas(path):
+    """Returns the number of entries in the delta log of the given folder."""
+    dfile = delta_file(path)
+    if not os.path.exists(dfile):
+        return 0
+    with open(dfile, 'rb') as f:
+        return sum(1 for raw in f if raw.endswith(b'\n'))
+
+
+def last_uoccin_seq(path):
+    """Returns the last sequence number used in the given folder: the one of the last delta log entry, or the one
+    folded in uoccin.json if the log is empty."""
+    if os.path.exists(seq_file(path)):
+        seq = _read_seq(path)
+    else:
+        # not migrated yet, the number may still be in the document
+        seq = _read_uoccin_file(path)[1]
+    dfile = delta_file(path)
+    if os.path.exists(dfile):
+        with open(dfile, 'rb') as f:
+            for raw in f:
+                if raw.endswith(b'\n'):
+                    try:
+                        seq = max(seq, int(raw.split(b'|', 1)[0]))
+                    except ValueError:
+                        pass
+    return seq
+
+
+def append_uoccin_deltas(path, changes):
+    """Appends (time, type, target, field, value) changes to the delta log of the given folder, with a single write.
+    Must be called holding uoccin_lock, the sequence numbers follow the last one in the log."""
+    dfile = delta_file(path)
+    seq = last_uoccin_seq(path)
+    lines = []
+    for change in changes:
+        seq += 1
+        lines.append('%d|%s|%s|%s|%s|%s\n' % ((seq,) + tuple(change)))
+    try:
+        with open(dfile, 'ab') as f:
+            f.write(''.join(lines).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as err:
+        raise plugin.PluginError('error writing %s: %s' % (dfile, err))
+    log.verbose('%d changes logged in %s (last sequence number: %d)' % (len(lines), dfile, seq))
+
+
+def save_uoccin_data(path, udata, compact=False):
+    """Writes the uoccin.json file in the given folder, folding the delta log (if any) in it.
+
+    The document is written to a temporary file first and then renamed over uoccin.json, so readers (and the cloud
+    sync client) never see a truncated file. With compact=True the json is serialized without indentation.
+    The document must include all the delta log entries: the last sequence number applied is written in uoccin.seq
+    before the log is deleted (after a crash right before that, the log is just replayed, setting the same values
+    again).
+    """
+    ufile = uoccin_file(path)
+    tmp = None
+    # not a field of the document, see seq_file
+    udata = dict(udata)
+    udata.pop('seq', None)
+    try:
+        seq = last_uoccin_seq(path)
+        if compact:
+            text = json.dumps(udata, sort_keys=True, separators=(',', ':'))
+        else:
+            text = json.dumps(udata, sort_keys=True, indent=4, separators=(',', ': '))
+        fd, tmp = tempfile.mkstemp(prefix='.uoccin.', suffix='.tmp', dir=path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(ufile):
+            shutil.copymode(ufile, tmp)
+        os.replace(tmp, ufile)
+        tmp = None
+        if os.path.exists(delta_file(path)):
+            _write_seq(path, seq)
+            os.remove(delta_file(path))
+    except Exception as err:
+        log.debug('error writing %s: %s' % (ufile, err))
+        raise plugin.PluginError('error writing %s: %s' % (ufile, err))
+    finally:
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+        invalidate_uoccin_data(path)
@@ -1,12 +1,18 @@
 from __future__ import unicode_literals, division, absolute_import
 from builtins import *  # pylint: disable=unused-import, redefined-builtin
 
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from flexget import plugin
 from flexget.entry import Entry
 from flexget.event import event
+from flexget.manager import Session
 from flexget.utils import json
+from flexget.utils.tools import parse_timedelta
 
 try:
     from flexget.components.thetvdb.api_tvdb import lookup_series
@@ -14,19 +20,142 @@ except ImportError:
     raise plugin.DependencyError(issued_by='uoccin', missing='api_tvdb',
                                  message='uoccin requires the `api_tvdb` plugin')
 
+from .uoccin_data import (load_uoccin_data, get_uoccin_index, apply_change, append_uoccin_deltas, save_uoccin_data,
+                          delta_file, uoccin_lock)
+from .uoccin_sqlite import open_uoccin_db, uoccin_db_file
 
-def load_uoccin_data(path):
-    udata = {}
-    ufile = os.path.join(path, 'uoccin.json')
-    if os.path.exists(ufile):
-        try:
-            with open(ufile, 'r') as f:
-                udata = json.load(f)
-        except Exception as err:
-            raise plugin.PluginError('error reading %s: %s' % (ufile, err))
-    udata.setdefault('movies', {})
-    udata.setdefault('series', {})
-    return udata
+log = logging.getLogger('uoccin_emit')
+
+# max concurrent lookups per site, whatever the number of threads
+DOMAIN_LIMITS = {'imdb.com': 2, 'thetvdb.com': 4}
+_domain_slots = dict((domain, threading.BoundedSemaphore(limit)) for domain, limit in DOMAIN_LIMITS.items())
+
+
+def lookup_series_name(tvdb_id):
+    """Returns the series name from tvdb, raises LookupError if not found. Safe to call from any thread: the database
+    session is not shared with the task (or with the other threads)."""
+    with Session() as session:
+        return lookup_series(tvdb_id=tvdb_id, session=session).name
+
+
+class NameCache(object):
+    """Persistent cache of the movies/series names found on imdb/tvdb: {'type:id': [name, timestamp]}.
+    It's kept in memory across tasks and saved in a json file in the FlexGet config folder."""
+
+    _instances = {}
+
+    @classmethod
+    def get_instance(cls, filename):
+        if filename not in cls._instances:
+            cls._instances[filename] = cls(filename)
+        return cls._instances[filename]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # one save at a time, they all write the same temporary file
+        self.save_lock = threading.Lock()
+        self.names = {}
+        self.changed = False
+        # 'type:id' keys being refreshed in background, so a name is never looked up twice at once
+        self.refreshing = set()
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self.names = json.load(f)
+            except Exception as err:
+                log.warning('error reading %s: %s' % (filename, err))
+
+    def get(self, typ, eid, ttl):
+        """Returns (name, fresh) for the given item, name is None if not cached."""
+        with self.lock:
+            item = self.names.get('%s:%s' % (typ, eid))
+        if not item:
+            return None, False
+        return item[0], time.time() - item[1] < ttl
+
+    def set(self, typ, eid, name):
+        with self.lock:
+            self.names['%s:%s' % (typ, eid)] = [name, time.time()]
+            self.changed = True
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                text = json.dumps(self.names)
+                self.changed = False
+            try:
+                tmp = self.filename + '.tmp'
+                with open(tmp, 'w') as f:
+                    f.write(text)
+                os.replace(tmp, self.filename)
+            except Exception as err:
+                log.warning('error writing %s: %s' % (self.filename, err))
+                with self.lock:
+                    self.changed = True
+
+    def refresh(self, typ, ids, lookup):
+        """Looks up again the names of the given items in a background thread, but the ones already being
+        refreshed by a previous call. Returns the thread, None if there's nothing to refresh."""
+        with self.lock:
+            ids = [eid for eid in ids if '%s:%s' % (typ, eid) not in self.refreshing]
+            self.refreshing.update('%s:%s' % (typ, eid) for eid in ids)
+        if not ids:
+            return None
+
+        def worker():
+            for eid in ids:
+                try:
+                    self.set(typ, eid, lookup(eid))
+                except LookupError as err:
+                    log.debug('unable to refresh %s %s name: %s' % (typ, eid, err))
+                finally:
+                    with self.lock:
+                        self.refreshing.discard('%s:%s' % (typ, eid))
+            self.save()
+            log.debug('%d %s names refreshed' % (len(ids), typ))
+
+        thread = threading.Thread(target=worker, name='uoccin_names')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class TagIndex(object):
+    """Inverted index of the tags of the movies/series in the watchlist of a document: {kind: {tag: frozenset(ids)}},
+    plus the (complement) set of the items without tags, so the tags filtering is done with set operations."""
+
+    def __init__(self, udata):
+        self.tags = {}
+        self.tagged = {}
+        self.untagged = {}
+        for kind, section in [('movie', udata['movies']), ('series', udata['series'])]:
+            tags = {}
+            untagged = set()
+            for eid, itm in section.items():
+                if not itm['watchlist']:
+                    continue
+                if not itm.get('tags'):
+                    untagged.add(eid)
+                for tag in itm.get('tags', []):
+                    tags.setdefault(tag, set()).add(eid)
+            self.tags[kind] = dict((tag, frozenset(ids)) for tag, ids in tags.items())
+            self.tagged[kind] = frozenset().union(*self.tags[kind].values())
+            self.untagged[kind] = frozenset(untagged)
+
+    def select(self, kind, tags=None, check_tags='any'):
+        """Returns the ids of the items in the watchlist matching the tags as uoccin_emit does."""
+        if not tags:
+            return self.tagged[kind] | self.untagged[kind]
+        sets = [self.tags[kind].get(tag, frozenset()) for tag in tags]
+        if check_tags == 'all':
+            return frozenset.intersection(*sets)
+        found = frozenset().union(*sets)
+        if check_tags == 'none':
+            return self.untagged[kind] | (self.tagged[kind] - found)
+        return found
 
 
 class UoccinEmit(object):
@@ -39,11 +168,90 @@ class UoccinEmit(object):
             'tags': {'type': 'array', 'items': {'type': 'string'}, 'minItems': 1},
             'check_tags': {'type': 'string', 'enum': ['any', 'all', 'none'], 'default': 'any'},
             'ep_flags': {'type': 'string', 'enum': ['watched', 'collected'], 'default': 'watched'},
+            'backend': {'type': 'string', 'enum': ['json', 'sqlite'], 'default': 'json'},
+            'names_ttl': {'type': 'string', 'format': 'interval', 'default': '7 days'},
+            'lookup_threads': {'type': 'integer', 'minimum': 1, 'default': 8},
+            'compact_json': {'type': 'boolean', 'default': False},
+            'series': {'type': 'array', 'items': {'type': 'string'}, 'minItems': 1},
+            'limit': {'type': 'integer', 'minimum': 1},
+            'stream': {'type': 'boolean', 'default': False},
         },
         'required': ['path', 'type'],
         'additionalProperties': False
     }
 
+    def __init__(self):
+        # {task name: names refresh thread}, joined when the task exits unless we're running as a daemon
+        self.refreshes = {}
+
+    def watchlist(self, task, config):
+        """Returns the (id, item) pairs in the watchlist matching the configured tags, sorted by id."""
+        kind = 'movie' if config['type'] == 'movies' else 'series'
+        if config['backend'] == 'sqlite':
+            db = open_uoccin_db(uoccin_db_file(task), config['path'])
+            try:
+                return db.watchlist(kind, config.get('tags'), config['check_tags'], config['type'] == 'episodes')
+            finally:
+                db.close()
+        # built once per document, shared by all the uoccin_emit tasks until the file changes
+        udata, index = get_uoccin_index(config['path'], 'tags', TagIndex)
+        ids = index.select(kind, config.get('tags'), config['check_tags'])
+        section = udata['movies'] if kind == 'movie' else udata['series']
+        return [(eid, section[eid]) for eid in sorted(ids)]
+
+    def lookup_name(self, kind, eid):
+        """Returns the movie/series name from imdb/tvdb, or None if not found."""
+        if kind == 'movie':
+            entry = Entry()
+            entry['url'] = 'http://www.imdb.com/title/' + eid
+            entry['imdb_id'] = eid
+            # called by the resolve_names threads, each with its own database session
+            with _domain_slots['imdb.com'], Session() as session:
+                try:
+                    plugin.get_plugin_by_name('imdb_lookup').instance.lookup(entry, session=session)
+                except plugin.PluginError as e:
+                    self.log.trace('entry %s imdb failed (%s)' % (eid, e.value))
+                    return None
+            return entry.get('imdb_name')
+        with _domain_slots['thetvdb.com']:
+            try:
+                return lookup_series_name(eid)
+            except LookupError:
+                self.log.warning('Unable to lookup series %s from tvdb, using raw name.' % eid)
+                return None
+
+    def resolve_names(self, kind, ids, threads):
+        """Looks up the names of the given movies/series concurrently, returns {id: name} for the ones found."""
+        if not ids:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(threads, len(ids))) as executor:
+            found = executor.map(lambda eid: self.lookup_name(kind, eid), ids)
+            return dict((eid, name) for eid, name in zip(ids, found) if name)
+
+    def store_names(self, task, config, kind, names):
+        """Writes the resolved {id: name} movies/series names back into the uoccin library."""
+        with uoccin_lock(config['path'], task.manager.config_base):
+            if config['backend'] == 'sqlite':
+                db = open_uoccin_db(uoccin_db_file(task), config['path'])
+                try:
+                    with db.conn:
+                        db.set_names(kind, names)
+                    db.export(config['compact_json'])
+                finally:
+                    db.close()
+                return
+            udata = load_uoccin_data(config['path'], cached=False)
+            ts = '%d' % (time.time() * 1000)
+            changes = [(ts, kind, eid, 'name', name) for eid, name in sorted(names.items())
+                       if apply_change(udata, kind, eid, 'name', name)]
+            if not changes:
+                return
+            if os.path.exists(delta_file(config['path'])):
+                # the delta log is in use (uoccin_reader with checkpoint_every), the next checkpoint will fold them in
+                append_uoccin_deltas(config['path'], changes)
+            else:
+                save_uoccin_data(config['path'], udata, config['compact_json'])
+
     def on_task_input(self, task, config):
         """Creates an entry for each item in your uoccin watchlist.
 
@@ -60,86 +268,151 @@ class UoccinEmit(object):
         - 'all' will only include the items marked with all the listed tags
         - 'none' will only include the items not marked with any of the listed tags.
 
+        With backend: sqlite the watchlist and tags are queried from the uoccin sqlite database (see uoccin_reader).
+
+        The names found on imdb/tvdb are cached (in the uoccin_names.json file, in the FlexGet config folder) for
+        names_ttl (default 7 days), then refreshed in background (unless FlexGet is running as a daemon, the task waits
+        for the refresh before exiting). The names still unknown in the library are looked up with up to lookup_threads
+        (default 8) concurrent requests and written back in the library, so they're only looked up once: they're added
+        to the delta log if there's one (see checkpoint_every in uoccin_reader), otherwise uoccin.json is written (with
+        compact_json, see uoccin_reader).
+
+        The series option only emits the listed series (by name or tvdb id), or their episodes. The limit option
+        stops after that many entries, taken from the first items of the watchlist by id. Both are applied before the
+        names are looked up, so only the names of the series left (or still unknown, for the series option) are.
+        With stream: yes the entries are returned as they're created, ordered by name (then season and episode
+        number), instead of being sorted by title (FlexGet still collects them in a list).
+
         The entries created will have a valid imdb/tvdb url and id.
         """
-        imdb_lookup = plugin.get_plugin_by_name('imdb_lookup').instance
-        udata = load_uoccin_data(config['path'])
-        section = udata['movies'] if config['type'] == 'movies' else udata['series']
-        entries = []
-        for eid, itm in list(section.items()):
-            if not itm['watchlist']:
-                continue
-            if 'tags' in config:
-                n = len(set(config['tags']) & set(itm.get('tags', [])))
-                if config['check_tags'] == 'any' and n <= 0:
-                    continue
-                if config['check_tags'] == 'all' and n != len(config['tags']):
-                    continue
-                if config['check_tags'] == 'none' and n > 0:
+        names = NameCache.get_instance(os.path.join(task.manager.config_base, 'uoccin_names.json'))
+        ttl = parse_timedelta(config['names_ttl']).total_seconds()
+        stats = {'hits': 0, 'lookups': 0, 'time': 0.0}
+        refresh = []
+        kind = 'movie' if config['type'] == 'movies' else 'series'
+        items = self.watchlist(task, config)
+        if 'series' in config:
+            items = self.select_series(config, items, names, ttl)
+        if 'limit' in config:
+            items = self.limit_items(config, items)
+        missing = [eid for eid, itm in items if itm['name'] == 'N/A' and not names.get(kind, eid, ttl)[0]]
+        started = time.time()
+        resolved = self.resolve_names(kind, missing, config['lookup_threads'])
+        stats['lookups'] = len(missing)
+        stats['time'] = time.time() - started
+        for eid, name in resolved.items():
+            names.set(kind, eid, name)
+        if resolved:
+            self.store_names(task, config, kind, resolved)
+        named = []
+        for eid, itm in items:
+            cached, fresh = names.get(kind, eid, ttl)
+            if kind == 'movie':
+                name = itm['name'] if itm['name'] != 'N/A' else resolved.get(eid, cached)
+                if itm['name'] == 'N/A' and eid not in resolved and cached:
+                    stats['hits'] += 1
+                if not name:
                     continue
-            if config['type'] == 'movies':
+            elif eid in resolved:
+                name = resolved[eid]
+            elif cached and fresh:
+                stats['hits'] += 1
+                name = cached
+            elif cached or itm['name'] != 'N/A':
+                # use what we have now, the name will be refreshed in background
+                name = cached or itm['name']
+                refresh.append(eid)
+            else:
+                name = itm['name']
+            named.append((name, eid, itm))
+        names.save()
+        thread = names.refresh('series', refresh, lookup_series_name)
+        if thread:
+            self.refreshes[task.name] = thread
+        self.log.verbose('names: %d cache hits, %d lookups (%.2f seconds), %d to refresh in background' %
+                         (stats['hits'], stats['lookups'], stats['time'], len(refresh)))
+        if 'series' in config:
+            # now that all the names are known
+            named = [(name, eid, itm) for name, eid, itm in named if self.wanted(config, eid, name)]
+        named.sort(key=lambda x: (x[0], x[1]))
+        entries = self.create_entries(config, named)
+        if config['stream']:
+            return entries
+        entries = list(entries)
+        entries.sort(key=lambda x: x['title'])
+        return entries
+
+    def on_task_exit(self, task, config):
+        thread = self.refreshes.pop(task.name, None)
+        if thread and not getattr(task.manager, 'is_daemon', False):
+            # the refresh thread would be killed (before saving the names) once FlexGet exits
+            self.log.verbose('waiting for the names refresh to complete')
+            thread.join()
+
+    on_task_abort = on_task_exit
+
+    def wanted(self, config, eid, name):
+        """Returns True if the series is one of the ones listed in the series option (by name or id)."""
+        return eid in config['series'] or name.lower() in set(sname.lower() for sname in config['series'])
+
+    def select_series(self, config, items, names, ttl):
+        """Returns the items matching the series option by id or by the name we already have (in the library or
+        cached), plus the ones whose name is still unknown: they have to be looked up to tell."""
+        kind = 'movie' if config['type'] == 'movies' else 'series'
+        selected = []
+        for eid, itm in items:
+            name = itm['name'] if itm['name'] != 'N/A' else names.get(kind, eid, ttl)[0]
+            if not name or self.wanted(config, eid, name):
+                selected.append((eid, itm))
+        return selected
+
+    def limit_items(self, config, items):
+        """Returns the first items (by id) providing up to limit entries."""
+        count = 0
+        for pos, (eid, itm) in enumerate(items):
+            if count >= config['limit']:
+                return items[:pos]
+            if config['type'] == 'episodes':
+                count += sum(len(season) for season in itm.get(config['ep_flags'], {}).values())
+            else:
+                count += 1
+        return items
+
+    def create_entries(self, config, named):
+        """Yields the entries for the given (name, id, item) movies/series, in the same order (and episodes sorted by
+        season and episode number), up to the configured limit."""
+        count = 0
+        for name, eid, itm in named:
+            if config['type'] == 'episodes':
+                episodes = self.episodes(itm, config['ep_flags'])
+            else:
+                episodes = [None]
+            for episode in episodes:
+                if 'limit' in config and count >= config['limit']:
+                    return
                 entry = Entry()
-                entry['url'] = 'http://www.imdb.com/title/' + eid
-                entry['imdb_id'] = eid
-                if itm['name'] != 'N/A':
-                    entry['title'] = itm['name']
+                if config['type'] == 'movies':
+                    entry['url'] = 'http://www.imdb.com/title/' + eid
+                    entry['imdb_id'] = eid
+                    entry['title'] = name
                 else:
-                    try:
-                        imdb_lookup.lookup(entry)
-                    except plugin.PluginError as e:
-                        self.log.trace('entry %s imdb failed (%s)' % (entry['imdb_id'], e.value))
-                        continue
-                    entry['title'] = entry.get('imdb_name')
-                if 'tags' in itm:
-                    entry['uoccin_tags'] = itm['tags']
+                    entry['url'] = 'http://thetvdb.com/?tab=series&id=' + eid
+                    entry['tvdb_id'] = eid
+                    entry['title'] = name if episode is None else '%s S%02dE%02d' % ((name,) + episode)
+                if episode is None and 'tags' in itm:
+                    entry['uoccin_tags'] = list(itm['tags'])
                 if entry.isvalid():
-                    entries.append(entry)
+                    count += 1
+                    yield entry
                 else:
                     self.log.debug('Invalid entry created? %s' % entry)
-            else:
-                sname = itm['name']
-                try:
-                    sname = lookup_series(tvdb_id=eid).name
-                except LookupError:
-                    self.log.warning('Unable to lookup series %s from tvdb, using raw name.' % eid)
-                surl = 'http://thetvdb.com/?tab=series&id=' + eid
-                if config['type'] == 'series':
-                    entry = Entry()
-                    entry['url'] = surl
-                    entry['title'] = sname
-                    entry['tvdb_id'] = eid
-                    if 'tags' in itm:
-                        entry['uoccin_tags'] = itm['tags']
-                    if entry.isvalid():
-                        entries.append(entry)
-                    else:
-                        self.log.debug('Invalid entry created? %s' % entry)
-                elif config['ep_flags'] == 'collected':
-                    slist = itm.get('collected', {})
-                    for sno in list(slist.keys()):
-                        for eno in slist[sno]:
-                            entry = Entry()
-                            entry['url'] = surl
-                            entry['title'] = '%s S%02dE%02d' % (sname, int(sno), int(eno))
-                            entry['tvdb_id'] = eid
-                            if entry.isvalid():
-                                entries.append(entry)
-                            else:
-                                self.log.debug('Invalid entry created? %s' % entry)
-                else:
-                    slist = itm.get('watched', {})
-                    for sno in list(slist.keys()):
-                        for eno in slist[sno]:
-                            entry = Entry()
-                            entry['url'] = surl
-                            entry['title'] = '%s S%02dE%02d' % (sname, int(sno), eno)
-                            entry['tvdb_id'] = eid
-                            if entry.isvalid():
-                                entries.append(entry)
-                            else:
-                                self.log.debug('Invalid entry created? %s' % entry)
-        entries.sort(key=lambda x: x['title'])
-        return entries
+
+    def episodes(self, itm, ep_flags):
+        """Yields the (season, episode) collected or watched in the series, sorted."""
+        slist = itm.get(ep_flags, {})
+        for sno in sorted(slist, key=int):
+            for eno in sorted(slist[sno], key=int):
+                yield int(sno), int(eno)
 
 
 @event('plugin.register')
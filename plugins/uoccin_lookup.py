@@ -1,29 +1,59 @@
 from __future__ import unicode_literals, division, absolute_import
 from builtins import *  # pylint: disable=unused-import, redefined-builtin
 
-import os
-
 from flexget import plugin
 from flexget.event import event
-from flexget.utils import json
 
+from .uoccin_data import get_uoccin_index
+from .uoccin_sqlite import open_uoccin_db, uoccin_db_file
 
-def load_uoccin_data(path):
-    udata = {}
-    ufile = os.path.join(path, 'uoccin.json')
-    if os.path.exists(ufile):
-        try:
-            with open(ufile, 'r') as f:
-                udata = json.load(f)
-        except Exception as err:
-            raise plugin.PluginError('error reading %s: %s' % (ufile, err))
-    udata.setdefault('movies', {})
-    udata.setdefault('series', {})
-    return udata
+COLLECTED = 1
+WATCHED = 2
+
+
+class EpisodeIndex(object):
+    """Flattened view of the collected/watched episodes of all the series in a document:
+    {(tvdb_id, season, episode): (flags, subtitles)}, with the same get_episode() of UoccinDatabase."""
+
+    def __init__(self, udata):
+        self.episodes = {}
+        for sid, ser in udata['series'].items():
+            for sno, season in ser.get('collected', {}).items():
+                for eno, subtitles in season.items():
+                    self.episodes[(sid, int(sno), int(eno))] = (COLLECTED, subtitles)
+            for sno, season in ser.get('watched', {}).items():
+                for eno in season:
+                    key = (sid, int(sno), int(eno))
+                    flags, subtitles = self.episodes.get(key, (0, None))
+                    self.episodes[key] = (flags | WATCHED, subtitles)
+
+    def get_episode(self, tvdb_id, season, episode):
+        """Returns (subtitles, watched) for the episode, where subtitles is None if the episode is not collected."""
+        flags, subtitles = self.episodes.get((tvdb_id, int(season), int(episode)), (0, None))
+        return subtitles if flags & COLLECTED else None, bool(flags & WATCHED)
 
 
 class UoccinLookup(object):
-    schema = {'type': 'string', 'format': 'path'}
+    schema = {
+        'oneOf': [
+            {'type': 'string', 'format': 'path'},
+            {
+                'type': 'object',
+                'properties': {
+                    'path': {'type': 'string', 'format': 'path'},
+                    'backend': {'type': 'string', 'enum': ['json', 'sqlite'], 'default': 'json'},
+                },
+                'required': ['path'],
+                'additionalProperties': False
+            }
+        ]
+    }
+
+    def prepare_config(self, config):
+        if not isinstance(config, dict):
+            config = {'path': config}
+        config.setdefault('backend', 'json')
+        return config
 
     # Run after metainfo_series / thetvdb_lookup / imdb_lookup
     @plugin.priority(100)
@@ -34,6 +64,12 @@ class UoccinLookup(object):
 
             uoccin_lookup: /path/to/gdrive/uoccin
 
+        or, to query the uoccin sqlite database (see uoccin_reader) instead of reading the whole uoccin.json file::
+
+            uoccin_lookup:
+              path: /path/to/gdrive/uoccin
+              backend: sqlite
+
         Resulting fields on entries:
 
         on series (requires tvdb_id):
@@ -58,44 +94,64 @@ class UoccinLookup(object):
         """
         if not task.entries:
             return
-        udata = load_uoccin_data(config)
-        movies = udata['movies']
-        series = udata['series']
-        for entry in task.entries:
-            entry['uoccin_watchlist'] = False
-            entry['uoccin_collected'] = False
-            entry['uoccin_watched'] = False
-            entry['uoccin_rating'] = None
-            entry['uoccin_tags'] = []
-            entry['uoccin_subtitles'] = []
-            if 'tvdb_id' in entry:
-                ser = series.get(str(entry['tvdb_id']))
-                if ser is None:
-                    continue
-                entry['uoccin_watchlist'] = ser.get('watchlist', False)
-                entry['uoccin_rating'] = ser.get('rating')
-                entry['uoccin_tags'] = ser.get('tags', [])
-                if all(field in entry for field in ['series_season', 'series_episode']):
-                    season = str(entry['series_season'])
-                    episode = entry['series_episode']
-                    edata = ser.get('collected', {}).get(season, {}).get(str(episode))
-                    entry['uoccin_collected'] = isinstance(edata, list)
-                    entry['uoccin_subtitles'] = edata if entry['uoccin_collected'] else []
-                    entry['uoccin_watched'] = episode in ser.get('watched', {}).get(season, [])
-            elif 'imdb_id' in entry:
+        config = self.prepare_config(config)
+        db = None
+        if config['backend'] == 'sqlite':
+            db = open_uoccin_db(uoccin_db_file(task), config['path'])
+            get_movie = db.get_movie
+            get_series = db.get_series
+            get_episode = db.get_episode
+        else:
+            # built once per document, reused by all the tasks until the file changes
+            udata, index = get_uoccin_index(config['path'], 'episodes', EpisodeIndex)
+            get_movie = udata['movies'].get
+            get_series = udata['series'].get
+            get_episode = index.get_episode
+        try:
+            for entry in task.entries:
+                self.lookup(entry, get_movie, get_series, get_episode)
+        finally:
+            if db:
+                db.close()
+
+    def lookup(self, entry, get_movie, get_series, get_episode):
+        # the lists are copied, the ones in the (cached) document are shared by all the tasks
+        entry['uoccin_watchlist'] = False
+        entry['uoccin_collected'] = False
+        entry['uoccin_watched'] = False
+        entry['uoccin_rating'] = None
+        entry['uoccin_tags'] = []
+        entry['uoccin_subtitles'] = []
+        if 'tvdb_id' in entry:
+            ser = get_series(str(entry['tvdb_id']))
+            if ser is None:
+                return
+            entry['uoccin_watchlist'] = ser.get('watchlist', False)
+            entry['uoccin_rating'] = ser.get('rating')
+            entry['uoccin_tags'] = list(ser.get('tags', []))
+            if all(field in entry for field in ['series_season', 'series_episode']):
                 try:
-                    mov = movies.get(entry['imdb_id'])
-                except plugin.PluginError as e:
-                    self.log.trace('entry %s imdb failed (%s)' % (entry['imdb_id'], e.value))
-                    continue
-                if mov is None:
-                    continue
-                entry['uoccin_watchlist'] = mov.get('watchlist', False)
-                entry['uoccin_collected'] = mov.get('collected', False)
-                entry['uoccin_watched'] = mov.get('watched', False)
-                entry['uoccin_rating'] = mov.get('rating')
-                entry['uoccin_tags'] = mov.get('tags', [])
-                entry['uoccin_subtitles'] = mov.get('subtitles', [])
+                    season, episode = int(entry['series_season']), int(entry['series_episode'])
+                except (TypeError, ValueError):
+                    # date or sequence based ids, uoccin only has season/episode numbers
+                    return
+                edata, entry['uoccin_watched'] = get_episode(str(entry['tvdb_id']), season, episode)
+                entry['uoccin_collected'] = isinstance(edata, list)
+                entry['uoccin_subtitles'] = list(edata) if entry['uoccin_collected'] else []
+        elif 'imdb_id' in entry:
+            try:
+                mov = get_movie(entry['imdb_id'])
+            except plugin.PluginError as e:
+                self.log.trace('entry %s imdb failed (%s)' % (entry['imdb_id'], e.value))
+                return
+            if mov is None:
+                return
+            entry['uoccin_watchlist'] = mov.get('watchlist', False)
+            entry['uoccin_collected'] = mov.get('collected', False)
+            entry['uoccin_watched'] = mov.get('watched', False)
+            entry['uoccin_rating'] = mov.get('rating')
+            entry['uoccin_tags'] = list(mov.get('tags', []))
+            entry['uoccin_subtitles'] = list(mov.get('subtitles', []))
 
 
 @event('plugin.register')
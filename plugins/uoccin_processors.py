@@ -1,16 +1,18 @@
 from __future__ import unicode_literals, division, absolute_import
 from builtins import *  # pylint: disable=unused-import, redefined-builtin
 
+import heapq
 import logging
+from collections import Counter
 import os
-import re
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from flexget import plugin
+from flexget import options, plugin
 from flexget.entry import Entry
 from flexget.event import event
-from flexget.utils import json
 
 try:
     from flexget.components.thetvdb.api_tvdb import lookup_series
@@ -18,19 +20,45 @@ except ImportError:
     raise plugin.DependencyError(issued_by='uoccin', missing='api_tvdb',
                                  message='uoccin requires the `api_tvdb` plugin')
 
+from .uoccin_data import (load_uoccin_data, save_uoccin_data, uoccin_file, apply_record, count_uoccin_deltas,
+                          append_uoccin_deltas, parse_change, format_change, format_value, uoccin_lock,
+                          is_diff_file, read_diff, write_diff, check_compression, FLAG_FIELDS)
+from .uoccin_sqlite import open_uoccin_db, uoccin_db_file
 
-def load_uoccin_data(path):
-    udata = {}
-    ufile = os.path.join(path, 'uoccin.json')
-    if os.path.exists(ufile):
-        try:
-            with open(ufile, 'r') as f:
-                udata = json.load(f)
-        except Exception as err:
-            raise plugin.PluginError('error reading %s: %s' % (ufile, err))
-    udata.setdefault('movies', {})
-    udata.setdefault('series', {})
-    return udata
+
+# outgoing diff files of the running tasks, so two writers never pick the same name
+_out_queues = set()
+_out_queues_lock = threading.Lock()
+
+# malformed lines logged as warnings in each process() call, the others are only counted
+MAX_WARNINGS = 10
+
+
+def compact_changes(changes):
+    """Returns the net effect of a time-ordered sequence of changes (parsed diff lines), in the same order.
+
+    The resulting library is the same as applying every line. Between two flags set to false for a movie/series
+    (which may delete it, tags, rating and subtitles included) only the first line setting a flag to true (which may
+    create it) and the last line for each other field are kept. The lines setting a flag to false and the episode
+    subtitles (which create the series as well) are always kept.
+    """
+    kept = {}
+    # {(type, movie/series id): number of flags set to false so far}
+    epochs = {}
+    for idx, change in enumerate(changes):
+        target = (change.typ, change.sid)
+        epoch = epochs.get(target, 0)
+        key = (change.typ, change.tid, change.field, epoch)
+        if change.field in FLAG_FIELDS and not change.value:
+            kept[idx] = (idx, change)
+            epochs[target] = epoch + 1
+        elif change.field in FLAG_FIELDS:
+            kept.setdefault(key, (idx, change))
+        elif change.field == 'subtitles' and change.episode is not None:
+            kept[idx] = (idx, change)
+        else:
+            kept[key] = (idx, change)
+    return [change for idx, change in sorted(kept.values())]
 
 
 class UoccinProcess(object):
@@ -38,7 +66,8 @@ class UoccinProcess(object):
     A diff file is a text file. Each line represent a modification in this form:
       time|type|target|field|value
     where:
-    - time is when the action took place. we'll sort the lines loaded from all the diff files prior to process them.
+    - time is when the action took place. each diff file is time-ordered, so we merge the lines of all the diff files
+      on the fly prior to process them.
     - type must be 'movie' or 'series'.
     - target can be the movie imdb_id, the series tvdb_id or the episode id (in the form tvdb_id.season.episode,
       i.e. "230435.2.14").
@@ -60,122 +89,159 @@ class UoccinProcess(object):
     def __init__(self):
         self.reset(None)
 
-    def reset(self, folder):
+    def reset(self, folder, compact_json=False, checkpoint_every=0, db_file=None, lock_dir=None):
         self.log = logging.getLogger('uoccin_process')
         self.folder = folder
-        self.changes = []
+        # where the lock file goes, the FlexGet config folder
+        self.lock_dir = lock_dir
+        self.db_file = db_file
+        self.compact_json = compact_json
+        self.checkpoint_every = checkpoint_every
+        self.dirty = False
+        self.files = []
+        self.commands = []
+        self.lines_read = 0
+        self.errors = Counter()
+        self.names = {}
+        self.lookups_saved = 0
 
     def load(self, filename):
-        with open(filename, 'r') as f:
-            lines = f.read().splitlines()
-        if lines:
-            self.log.info('found %d changes in %s' % (len(lines), filename))
-            self.changes.extend(lines)
+        """Queues a diff file for the next process() call. The file is only read when processing."""
+        self.files.append(filename)
+
+    def add_changes(self, lines):
+        """Queues (time-ordered) diff lines we already have in memory for the next process() call."""
+        self.commands.extend(lines)
+
+    def parse_changes(self, lines, source='commands'):
+        """Yields a Change for each valid line, the malformed ones are counted (by reason) and skipped."""
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            self.lines_read += 1
+            try:
+                yield parse_change(line)
+            except ValueError as err:
+                reason = '%s' % err
+                self.errors[reason] += 1
+                if sum(self.errors.values()) <= MAX_WARNINGS:
+                    self.log.warning('skipping malformed line in %s: "%s" (%s)' % (source, line, reason))
+
+    def read_changes(self, filename):
+        """Yields a Change for each valid line in a diff file."""
+        count = 0
+        for change in self.parse_changes(read_diff(filename), filename):
+            count += 1
+            yield change
+        if count:
+            self.log.info('found %d changes in %s' % (count, filename))
         else:
             self.log.debug('no changes found in %s' % filename)
 
+    def lookup_name(self, typ, tid):
+        """Returns the movie/series name from imdb/tvdb, or None if not found.
+        Each target is resolved at most once per process() call."""
+        key = (typ, tid)
+        if key in self.names:
+            self.lookups_saved += 1
+            return self.names[key]
+        name = None
+        if typ == 'movie':
+            fake = Entry()
+            fake['url'] = 'http://www.imdb.com/title/' + tid
+            fake['imdb_id'] = tid
+            try:
+                self.imdb_lookup.lookup(fake)
+                name = fake.get('imdb_name')
+            except plugin.PluginError:
+                self.log.warning('Unable to lookup movie %s from imdb, using raw name.' % tid)
+        else:
+            try:
+                name = lookup_series(tvdb_id=tid).name
+            except LookupError:
+                self.log.warning('Unable to lookup series %s from tvdb, using raw name.' % tid)
+        self.names[key] = name
+        return name
+
     def process(self):
-        imdb_lookup = plugin.get_plugin_by_name('imdb_lookup').instance
-        self.changes.sort()
-        udata = load_uoccin_data(self.folder)
-        for line in self.changes:
-            tmp = line.split('|')
-            typ = tmp[1]
-            tid = tmp[2]
-            fld = tmp[3]
-            val = tmp[4]
-            self.log.verbose('processing: type=%s, target=%s, field=%s, value=%s' % (typ, tid, fld, val))
-            if typ == 'movie':
-                # default
-                mov = udata['movies'].setdefault(tid,
-                                                 {'name': 'N/A', 'watchlist': False, 'collected': False,
-                                                  'watched': False})
-                # movie title is unknown at this time
-                fake = Entry()
-                fake['url'] = 'http://www.imdb.com/title/' + tid
-                fake['imdb_id'] = tid
-                try:
-                    imdb_lookup.lookup(fake)
-                    mov['name'] = fake.get('imdb_name')
-                except plugin.PluginError:
-                    self.log.warning('Unable to lookup movie %s from imdb, using raw name.' % tid)
-                # setting
-                if fld == 'watchlist':
-                    mov['watchlist'] = val == 'true'
-                elif fld == 'collected':
-                    mov['collected'] = val == 'true'
-                elif fld == 'watched':
-                    mov['watched'] = val == 'true'
-                elif fld == 'tags':
-                    mov['tags'] = re.split(',\s*', val)
-                elif fld == 'subtitles':
-                    mov['subtitles'] = re.split(',\s*', val)
-                elif fld == 'rating':
-                    mov['rating'] = int(val)
-                # cleaning
-                if not (mov['watchlist'] or mov['collected'] or mov['watched']):
-                    self.log.verbose('deleting unused section: movies\%s' % tid)
-                    udata['movies'].pop(tid)
-            elif typ == 'series':
-                tmp = tid.split('.')
-                sid = tmp[0]
-                sno = tmp[1] if len(tmp) > 2 else None
-                eno = tmp[2] if len(tmp) > 2 else None
-                # default
-                ser = udata['series'].setdefault(sid,
-                                                 {'name': 'N/A', 'watchlist': False, 'collected': {}, 'watched': {}})
-                # series name is unknown at this time
-                try:
-                    series = lookup_series(tvdb_id=sid)
-                    ser['name'] = series.name
-                except LookupError:
-                    self.log.warning('Unable to lookup series %s from tvdb, using raw name.' % sid)
-                # setting
-                if fld == 'watchlist':
-                    ser['watchlist'] = val == 'true'
-                elif fld == 'tags':
-                    ser['tags'] = re.split(',\s*', val)
-                elif fld == 'rating':
-                    ser['rating'] = int(val)
-                elif sno is None or eno is None:
-                    self.log.warning('invalid line "%s": season and episode numbers are required' % line)
-                elif fld == 'collected':
-                    season = ser['collected'].setdefault(sno, {})
-                    if val == 'true':
-                        season.setdefault(eno, [])
-                    else:
-                        if eno in season:
-                            season.pop(eno)
-                        if not season:
-                            self.log.verbose('deleting unused section: series\%s\collected\%s' % (sid, sno))
-                            ser['collected'].pop(sno)
-                elif fld == 'subtitles':
-                    ser['collected'].setdefault(sno, {})[eno] = re.split(',\s*', val)
-                elif fld == 'watched':
-                    season = ser['watched'].setdefault(sno, [])
-                    if val == 'true':
-                        season = ser['watched'][sno] = list(set(season) | set([int(eno)]))
-                    elif int(eno) in season:
-                        season.remove(int(eno))
-                    season.sort()
-                    if not season:
-                        self.log.debug('deleting unused section: series\%s\watched\%s' % (sid, sno))
-                        ser['watched'].pop(sno)
-                # cleaning
-                if not (ser['watchlist'] or ser['collected'] or ser['watched']):
-                    self.log.debug('deleting unused section: series\%s' % sid)
-                    udata['series'].pop(sid)
+        self.imdb_lookup = plugin.get_plugin_by_name('imdb_lookup').instance
+        self.names = {}
+        self.lookups_saved = 0
+        self.dirty = False
+        # k-way merge of the (already time-ordered) diff files, so we never hold more than a line per file
+        self.lines_read = 0
+        self.errors = Counter()
+        sources = [self.read_changes(fn) for fn in self.files]
+        if self.commands:
+            sources.append(self.parse_changes(self.commands))
+        merged = heapq.merge(*sources)
+        changes = compact_changes(merged)
+        if self.errors:
+            self.log.warning('%d malformed lines skipped: %s' % (
+                sum(self.errors.values()), ', '.join('%s (%d)' % item for item in sorted(self.errors.items()))))
+        if len(changes) < self.lines_read:
+            self.log.verbose('%d changes compacted to %d' % (self.lines_read, len(changes)))
+        # nobody else can update the library from our load to our save
+        with uoccin_lock(self.folder, self.lock_dir):
+            db = None
+            targets = None
+            if self.db_file:
+                # only the movies/series involved are loaded from the database
+                db = open_uoccin_db(self.db_file, self.folder)
+                targets = set((change.typ, change.sid) for change in changes)
+                udata = db.load_items(targets)
             else:
-                self.log.warning('invalid element type "%s"' % typ)
-        # save the updated uoccin.json
-        ufile = os.path.join(self.folder, 'uoccin.json')
-        try:
-            text = json.dumps(udata, sort_keys=True, indent=4, separators=(',', ': '))
-            with open(ufile, 'w') as f:
-                f.write(text)
-        except Exception as err:
-            self.log.debug('error writing %s: %s' % (ufile, err))
-            raise plugin.PluginError('error writing %s: %s' % (ufile, err))
+                udata = load_uoccin_data(self.folder, cached=False)
+            try:
+                deltas = self.apply_changes(udata, changes)
+                self.save(udata, deltas, db, targets)
+            finally:
+                if db:
+                    db.close()
+
+    def apply_changes(self, udata, changes):
+        """Applies the changes to the document, returns the ones which actually changed something (plus the
+        resolved names) as (time, type, target, field, value)."""
+        deltas = []
+        for change in changes:
+            typ = change.typ
+            key = change.sid
+            val = format_value(change)
+            self.log.verbose('processing: type=%s, target=%s, field=%s, value=%s' % (typ, change.tid, change.field,
+                                                                                     val))
+            section = udata['movies'] if typ == 'movie' else udata['series']
+            # movie/series name is unknown at this time
+            item = section.get(key)
+            name = None
+            if item is None or item['name'] == 'N/A':
+                name = self.lookup_name(typ, key)
+            else:
+                self.lookups_saved += 1
+            old_name = item['name'] if item is not None else None
+            if apply_record(udata, change, name):
+                self.dirty = True
+                deltas.append((change.ts, typ, change.tid, change.field, val))
+                if name and name != old_name and key in section:
+                    deltas.append((change.ts, typ, key, 'name', name))
+        if changes:
+            self.log.verbose('%d names resolved, %d lookups saved' % (len(self.names), self.lookups_saved))
+        return deltas
+
+    def save(self, udata, deltas, db=None, targets=None):
+        # save the updated uoccin.json (or just log the changes)
+        if not self.dirty:
+            self.log.debug('no changes to %s, not writing it' % uoccin_file(self.folder))
+            return
+        if db:
+            # a single transaction for the whole batch, then the export for the Android app
+            with db.conn:
+                db.store_items(udata, targets)
+            db.export(self.compact_json)
+        elif self.checkpoint_every and count_uoccin_deltas(self.folder) + len(deltas) < self.checkpoint_every:
+            append_uoccin_deltas(self.folder, deltas)
+        else:
+            save_uoccin_data(self.folder, udata, self.compact_json)
 
 
 class UoccinReader(object):
@@ -184,18 +250,74 @@ class UoccinReader(object):
         'properties': {
             'uuid': {'type': 'string'},
             'path': {'type': 'string', 'format': 'path'},
+            'compact_json': {'type': 'boolean', 'default': False},
+            'checkpoint_every': {'type': 'integer', 'minimum': 0, 'default': 0},
+            'backend': {'type': 'string', 'enum': ['json', 'sqlite'], 'default': 'json'},
         },
         'required': ['uuid', 'path'],
         'additionalProperties': False
     }
 
-    processor = UoccinProcess()
+    def __init__(self):
+        # {task name: UoccinProcess}, so different tasks can run in parallel
+        self.processors = {}
 
     def on_task_start(self, task, config):
-        UoccinReader.processor.reset(config['path'])
+        processor = UoccinProcess()
+        processor.reset(config['path'], config['compact_json'], config['checkpoint_every'],
+                        uoccin_db_file(task) if config['backend'] == 'sqlite' else None, task.manager.config_base)
+        self.processors[task.name] = processor
+        if task.options.uoccin_compact_diffs:
+            self.compact_diffs(config)
+
+    def compact_diffs(self, config):
+        """Replaces the queued foreign diff files in the local device folder with a single compacted one.
+        The files are merged by time before compacting, as process() does, so the result is the same as applying
+        all of them."""
+        my_folder = os.path.join(config['path'], 'device.' + config['uuid'])
+        if not os.path.isdir(my_folder):
+            return
+        files = [os.path.join(my_folder, fn) for fn in sorted(os.listdir(my_folder))
+                 if is_diff_file(fn) and config['uuid'] not in fn]
+        if not files:
+            return
+        sources = []
+        lines = 0
+        for filename in files:
+            try:
+                changes = [parse_change(line.rstrip('\r\n')) for line in read_diff(filename) if line.strip()]
+            except ValueError as err:
+                self.log.warning('diff files not compacted, %s contains malformed lines (%s)' % (
+                    os.path.basename(filename), err))
+                return
+            lines += len(changes)
+            sources.append(changes)
+        changes = compact_changes(heapq.merge(*sources))
+        if len(files) == 1 and len(changes) >= lines:
+            return
+        if not changes:
+            compacted = None
+        else:
+            # named after the first change, so it's still processed in the right order by any device
+            compacted = os.path.join(my_folder, '%d.compacted.diff' % changes[0].ts)
+            tmp = compacted + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(''.join(format_change(change) + '\n' for change in changes))
+            os.replace(tmp, compacted)
+        for filename in files:
+            if filename != compacted:
+                os.remove(filename)
+        self.log.info('%d diff files (%d changes) compacted to %d changes' % (len(files), lines, len(changes)))
 
     def on_task_exit(self, task, config):
-        UoccinReader.processor.process()
+        processor = self.processors.pop(task.name)
+        processor.process()
+        # the diff files are read while processing, so they can only be deleted now
+        for filename in processor.files:
+            os.remove(filename)
+
+    def on_task_abort(self, task, config):
+        self.processors.pop(task.name, None)
 
     def on_task_output(self, task, config):
         """Process incoming diff to update the uoccin.json file. Requires the location field.
@@ -214,46 +336,137 @@ class UoccinReader(object):
               path: '{{ secrets.uoccin.path }}'
 
         Note::
-        - the uoccin.json file will be created if not exists.
+        - the uoccin.json file will be created if not exists, and only rewritten when something has changed.
         - the uuid must be a filename-safe text.
+        - with compact_json: yes the uoccin.json file is written without indentation (smaller and faster to write).
+        - with checkpoint_every: N the changes are appended to a uoccin.delta log instead of rewriting uoccin.json,
+          which is only rewritten (folding the log in it) once the log reaches N changes. The other uoccin plugins
+          read both files, but keep in mind uoccin.json alone is only updated up to the last checkpoint.
+        - with backend: sqlite the library is kept in an indexed sqlite database in the FlexGet config folder, which
+          uoccin_lookup and uoccin_emit can query with the same option. The database imports uoccin.json whenever
+          someone else changes it, and exports it after every change (checkpoint_every is ignored).
+        - compressed diff files (.diff.gz, .diff.zst) are read as well, see the uoccin writers compression option.
+        - the library is updated holding an advisory lock (a uoccin.*.lock file in the FlexGet config folder, not in
+          path which is synced), so the uoccin tasks can run in parallel, even in different FlexGet instances sharing
+          the config folder.
         """
         for entry in task.accepted:
             if entry.get('location'):
                 fn = os.path.basename(entry['location'])
-                if fn.endswith('.diff') and not (config['uuid'] in fn):
-                    UoccinReader.processor.load(entry['location'])
-                    os.remove(entry['location'])
+                if is_diff_file(fn) and not (config['uuid'] in fn):
+                    self.processors[task.name].load(entry['location'])
                 else:
                     self.log.debug('skipping %s (not a foreign diff file)' % fn)
 
 
 class UoccinWriter(object):
-    out_queue = ''
+    """Base class for the uoccin output plugins. The commands are buffered in memory and written in the outgoing diff
+    file at the end of the task (or every max_buffer commands), then applied to uoccin.json and sent to the other
+    devices.
+
+    With compression: gzip (or zstd, requires the zstandard package) the diff file is sent compressed (.diff.gz or
+    .diff.zst, with delta-encoded times) to cut the cloud transfers: only use it if all the other devices read the
+    diff files with uoccin_reader, since the Android app only reads plain .diff files.
+    """
+
+    # the options shared by all the writers, the subclasses extend the properties with their own
+    schema = {
+        'type': 'object',
+        'properties': {
+            'uuid': {'type': 'string'},
+            'path': {'type': 'string', 'format': 'path'},
+            'compact_json': {'type': 'boolean', 'default': False},
+            'checkpoint_every': {'type': 'integer', 'minimum': 0, 'default': 0},
+            'backend': {'type': 'string', 'enum': ['json', 'sqlite'], 'default': 'json'},
+            'max_buffer': {'type': 'integer', 'minimum': 1, 'default': 1000},
+            'compression': {'type': 'string', 'enum': ['none', 'gzip', 'zstd'], 'default': 'none'},
+        },
+        'required': ['uuid', 'path'],
+        'additionalProperties': False
+    }
+
+    def __init__(self):
+        # {task name: {'out_queue': outgoing diff file, 'out_buffer': commands waiting to be written in it,
+        #              'max_buffer': max commands in out_buffer}}, so different tasks can run in parallel
+        self.queues = {}
 
     def on_task_start(self, task, config):
+        # fail now rather than once the commands have been applied
+        check_compression(config['compression'])
         # create the local device folder if not exists
         my_folder = os.path.join(config['path'], 'device.' + config['uuid'])
         if not os.path.exists(my_folder):
             os.makedirs(my_folder)
         # define the filename for the outgoing diff file
-        ts = int(time.time() * 1000)
-        fn = '%d.%s.diff' % (ts, config['uuid'])
-        UoccinWriter.out_queue = os.path.join(my_folder, fn)
+        with _out_queues_lock:
+            ts = int(time.time() * 1000)
+            while True:
+                out_queue = os.path.join(my_folder, '%d.%s.diff' % (ts, config['uuid']))
+                if out_queue not in _out_queues and not os.path.exists(out_queue):
+                    break
+                ts += 1
+            _out_queues.add(out_queue)
+        self.queues[task.name] = {'out_queue': out_queue, 'out_buffer': [], 'max_buffer': config['max_buffer']}
+
+    def on_task_abort(self, task, config):
+        queue = self.queues.pop(task.name, None)
+        if queue:
+            with _out_queues_lock:
+                _out_queues.discard(queue['out_queue'])
 
     def on_task_exit(self, task, config):
-        if os.path.exists(UoccinWriter.out_queue):
+        queue = self.queues.pop(task.name)
+        try:
+            self.process_queue(task, config, queue)
+        finally:
+            with _out_queues_lock:
+                _out_queues.discard(queue['out_queue'])
+
+    def process_queue(self, task, config, queue):
+        out_queue = queue['out_queue']
+        # unless the diff file has already been (partially) written, we can apply the commands we have in memory
+        # instead of reading it back
+        commands = None if os.path.exists(out_queue) else queue['out_buffer']
+        self.flush_commands(queue)
+        if os.path.exists(out_queue):
             # update uoccin.json
             up = UoccinProcess()
-            up.reset(config['path'])
-            up.load(UoccinWriter.out_queue)
+            up.reset(config['path'], config['compact_json'], config['checkpoint_every'],
+                     uoccin_db_file(task) if config['backend'] == 'sqlite' else None, task.manager.config_base)
+            if commands:
+                up.add_changes(commands)
+            else:
+                up.load(out_queue)
             up.process()
             # copy the diff file in other devices folders
-            for fld in next(os.walk(config['path']))[1]:
-                if fld.startswith('device.') and fld != ('device.' + config['uuid']):
-                    shutil.copy2(UoccinWriter.out_queue, os.path.join(config['path'], fld))
-                    self.log.verbose('%s copied in %s' % (UoccinWriter.out_queue, fld))
+            if config['compression'] == 'none':
+                self.send_diff(config, out_queue)
+            else:
+                sent = write_diff(out_queue, commands or read_diff(out_queue), config['compression'])
+                try:
+                    self.send_diff(config, sent)
+                finally:
+                    os.remove(sent)
             # delete the diff file in the local device folder
-            os.remove(UoccinWriter.out_queue)
+            os.remove(out_queue)
+
+    def send_diff(self, config, src):
+        """Puts the outgoing diff file in the other devices folders: as a hardlink where the filesystem supports it,
+        otherwise as a copy (in parallel, since every copy is a roundtrip for the cloud sync client)."""
+        copies = []
+        for fld in next(os.walk(config['path']))[1]:
+            if fld.startswith('device.') and fld != ('device.' + config['uuid']):
+                try:
+                    os.link(src, os.path.join(config['path'], fld, os.path.basename(src)))
+                    self.log.verbose('%s linked in %s' % (src, fld))
+                except (OSError, AttributeError):
+                    copies.append(fld)
+        if not copies:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(copies), 4)) as executor:
+            for fld, dummy in zip(copies, executor.map(lambda f: shutil.copy2(src, os.path.join(config['path'], f)),
+                                                       copies)):
+                self.log.verbose('%s copied in %s' % (src, fld))
     
     def get_target_type(self, entry, episode):
         tid = None
@@ -272,11 +485,23 @@ class UoccinWriter(object):
             typ = 'movie'
         return typ, tid
 
-    def append_command(self, target, title, field, value):
+    def append_command(self, task, target, title, field, value):
+        queue = self.queues[task.name]
         ts = int(time.time() * 1000)
-        line = '%d|%s|%s|%s|%s\n' % (ts, target, title, field, value)
-        with open(UoccinWriter.out_queue, 'a') as f:
-            f.write(line)
+        queue['out_buffer'].append('%d|%s|%s|%s|%s\n' % (ts, target, title, field, value))
+        if len(queue['out_buffer']) >= queue['max_buffer']:
+            self.flush_commands(queue)
+
+    def flush_commands(self, queue):
+        """Writes the buffered commands in the outgoing diff file, with a single write."""
+        if not queue['out_buffer']:
+            return
+        with open(queue['out_queue'], 'a') as f:
+            f.write(''.join(queue['out_buffer']))
+            f.flush()
+            os.fsync(f.fileno())
+        self.log.debug('%d commands written in %s' % (len(queue['out_buffer']), queue['out_queue']))
+        queue['out_buffer'] = []
 
 
 class UoccinWatchlist(UoccinWriter):
@@ -308,51 +533,24 @@ class UoccinWatchlist(UoccinWriter):
             if tid is None:
                 self.log.warning('Skipping entry with invalid tvdb_id/imdb_id: %s' % entry)
                 continue
-            self.append_command(typ, tid, 'watchlist', str(self.set_true).lower())
+            self.append_command(task, typ, tid, 'watchlist', str(self.set_true).lower())
             if self.set_true:
-                self.append_command(typ, tid, 'tags', ",".join(config['tags']))
+                self.append_command(task, typ, tid, 'tags', ",".join(config['tags']))
 
 
 class UoccinWlstAdd(UoccinWatchlist):
     """Add all accepted series/movies to Uoccin watchlist."""
-    schema = {
-        'type': 'object',
-        'properties': {
-            'uuid': {'type': 'string'},
-            'path': {'type': 'string', 'format': 'path'},
-            'tags': {'type': 'array', 'items': {'type': 'string'}, 'minItems': 1},
-        },
-        'required': ['uuid', 'path'],
-        'additionalProperties': False
-    }
+    schema = dict(UoccinWriter.schema, properties=dict(
+        UoccinWriter.schema['properties'], tags={'type': 'array', 'items': {'type': 'string'}, 'minItems': 1}))
     set_true = True
 
 
 class UoccinWlstDel(UoccinWatchlist):
     """Remove all accepted elements from Uoccin watchlist."""
-    schema = {
-        'type': 'object',
-        'properties': {
-            'uuid': {'type': 'string'},
-            'path': {'type': 'string', 'format': 'path'},
-        },
-        'required': ['uuid', 'path'],
-        'additionalProperties': False
-    }
     set_true = False
 
 
 class UoccinCollection(UoccinWriter):
-    schema = {
-        'type': 'object',
-        'properties': {
-            'uuid': {'type': 'string'},
-            'path': {'type': 'string', 'format': 'path'},
-        },
-        'required': ['uuid', 'path'],
-        'additionalProperties': False
-    }
-
     # Defined by subclasses
     set_true = None
 
@@ -375,9 +573,9 @@ class UoccinCollection(UoccinWriter):
             if tid is None:
                 self.log.warning('Skipping entry with invalid tvdb_id/imdb_id: %s' % entry)
                 continue
-            self.append_command(typ, tid, 'collected', str(self.set_true).lower())
+            self.append_command(task, typ, tid, 'collected', str(self.set_true).lower())
             if self.set_true and 'subtitles' in entry:
-                self.append_command(typ, tid, 'subtitles', ",".join(entry['subtitles']))
+                self.append_command(task, typ, tid, 'subtitles', ",".join(entry['subtitles']))
 
 
 class UoccinCollAdd(UoccinCollection):
@@ -391,16 +589,6 @@ class UoccinCollDel(UoccinCollection):
 
 
 class UoccinWatched(UoccinWriter):
-    schema = {
-        'type': 'object',
-        'properties': {
-            'uuid': {'type': 'string'},
-            'path': {'type': 'string', 'format': 'path'},
-        },
-        'required': ['uuid', 'path'],
-        'additionalProperties': False
-    }
-
     # Defined by subclasses
     set_true = None
 
@@ -423,7 +611,7 @@ class UoccinWatched(UoccinWriter):
             if tid is None:
                 self.log.warning('Skipping entry with invalid tvdb_id/imdb_id: %s' % entry)
                 continue
-            self.append_command(typ, tid, 'watched', str(self.set_true).lower())
+            self.append_command(task, typ, tid, 'watched', str(self.set_true).lower())
 
 
 class UoccinSeenAdd(UoccinWatched):
@@ -437,16 +625,6 @@ class UoccinSeenDel(UoccinWatched):
 
 
 class UoccinSubtitles(UoccinWriter):
-    schema = {
-        'type': 'object',
-        'properties': {
-            'uuid': {'type': 'string'},
-            'path': {'type': 'string', 'format': 'path'},
-        },
-        'required': ['uuid', 'path'],
-        'additionalProperties': False
-    }
-
     def on_task_output(self, task, config):
         """Set subtitles info for accepted episodes and/or movies in the uoccin.json file.
         Requires the subtitles field (set by subtitles_check plugin), plus tvdb_id, series_season and series_episode
@@ -470,7 +648,14 @@ class UoccinSubtitles(UoccinWriter):
             if tid is None:
                 self.log.warning('Skipping entry with invalid tvdb_id/imdb_id: %s' % entry)
                 continue
-            self.append_command(typ, tid, 'subtitles', ",".join(entry['subtitles']))
+            self.append_command(task, typ, tid, 'subtitles', ",".join(entry['subtitles']))
+
+
+@event('options.register')
+def register_parser_arguments():
+    options.get_parser('execute').add_argument('--uoccin-compact-diffs', action='store_true',
+                                               dest='uoccin_compact_diffs', default=False,
+                                               help='merge the queued uoccin diff files in a single compacted one')
 
 
 @event('plugin.register')
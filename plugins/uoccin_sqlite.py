@@ -0,0 +1,235 @@
+from __future__ import unicode_literals, division, absolute_import
+from builtins import *  # pylint: disable=unused-import, redefined-builtin
+
+import logging
+import os
+import sqlite3
+
+from flexget import plugin
+from flexget.utils import json
+
+from .uoccin_data import load_uoccin_data, save_uoccin_data, uoccin_file, delta_file, file_signature
+
+log = logging.getLogger('uoccin_sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS movies (imdb_id TEXT PRIMARY KEY, name TEXT, watchlist INTEGER, collected INTEGER,
+                                   watched INTEGER, rating INTEGER, tags TEXT, subtitles TEXT);
+CREATE TABLE IF NOT EXISTS series (tvdb_id TEXT PRIMARY KEY, name TEXT, watchlist INTEGER, rating INTEGER, tags TEXT);
+CREATE TABLE IF NOT EXISTS episodes (tvdb_id TEXT, season INTEGER, episode INTEGER, collected INTEGER,
+                                     subtitles TEXT, watched INTEGER, PRIMARY KEY (tvdb_id, season, episode));
+CREATE TABLE IF NOT EXISTS tags (kind TEXT, id TEXT, tag TEXT, PRIMARY KEY (kind, id, tag));
+CREATE INDEX IF NOT EXISTS movies_watchlist ON movies (watchlist);
+CREATE INDEX IF NOT EXISTS series_watchlist ON series (watchlist);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (kind, tag);
+'''
+
+
+def uoccin_db_file(task):
+    """Returns the sqlite database used by the uoccin plugins with backend: sqlite. We keep it in the FlexGet config
+    folder rather than in the uoccin one, since the latter is usually synced by a cloud client."""
+    return os.path.join(task.manager.config_base, 'uoccin.sqlite')
+
+
+def _load(text):
+    return json.loads(text) if text is not None else None
+
+
+def _dump(value):
+    return json.dumps(value) if value is not None else None
+
+
+class UoccinDatabase(object):
+    """Sqlite storage for a uoccin library, with indexed tables for movies, series, episodes and tags.
+
+    The database is the working copy: the uoccin.json file (plus delta log, if any) is imported again whenever it has
+    been changed by someone else, and exported after every change for the Android app.
+    """
+
+    def __init__(self, filename, path):
+        self.path = path
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def json_signature(self):
+        return json.dumps([file_signature(uoccin_file(self.path)), file_signature(delta_file(self.path))])
+
+    def sync(self):
+        """Imports the uoccin.json file if it has been changed since our last import/export (or if it's another one)."""
+        sig = self.json_signature()
+        if self.get_meta('path') == os.path.abspath(self.path) and self.get_meta('signature') == sig:
+            return
+        udata = load_uoccin_data(self.path, cached=False)
+        with self.conn:
+            for table in ['movies', 'series', 'episodes', 'tags']:
+                self.conn.execute('DELETE FROM %s' % table)
+            self.store_items(udata, [('movie', tid) for tid in udata['movies']] +
+                             [('series', sid) for sid in udata['series']])
+            self.set_meta('path', os.path.abspath(self.path))
+            self.set_meta('signature', sig)
+        log.verbose('%s imported (%d movies, %d series)' % (uoccin_file(self.path), len(udata['movies']),
+                                                             len(udata['series'])))
+
+    def export(self, compact=False):
+        """Writes the whole library in the uoccin.json file."""
+        save_uoccin_data(self.path, self.dump(), compact)
+        with self.conn:
+            self.set_meta('signature', self.json_signature())
+
+    def movie_item(self, row):
+        mov = {'name': row[1], 'watchlist': bool(row[2]), 'collected': bool(row[3]), 'watched': bool(row[4])}
+        if row[5] is not None:
+            mov['rating'] = row[5]
+        if row[6] is not None:
+            mov['tags'] = _load(row[6])
+        if row[7] is not None:
+            mov['subtitles'] = _load(row[7])
+        return mov
+
+    def series_item(self, row, episodes=None):
+        ser = {'name': row[1], 'watchlist': bool(row[2]), 'collected': {}, 'watched': {}}
+        if row[3] is not None:
+            ser['rating'] = row[3]
+        if row[4] is not None:
+            ser['tags'] = _load(row[4])
+        for sno, eno, collected, subtitles, watched in episodes or []:
+            if collected:
+                ser['collected'].setdefault(str(sno), {})[str(eno)] = _load(subtitles) or []
+            if watched:
+                ser['watched'].setdefault(str(sno), []).append(eno)
+        return ser
+
+    def get_movie(self, imdb_id):
+        row = self.conn.execute('SELECT * FROM movies WHERE imdb_id = ?', (imdb_id,)).fetchone()
+        return self.movie_item(row) if row else None
+
+    def get_series(self, tvdb_id, episodes=False):
+        """Returns the series data, without the collected/watched episodes unless requested."""
+        row = self.conn.execute('SELECT * FROM series WHERE tvdb_id = ?', (tvdb_id,)).fetchone()
+        if not row:
+            return None
+        eps = None
+        if episodes:
+            eps = self.conn.execute('SELECT season, episode, collected, subtitles, watched FROM episodes '
+                                    'WHERE tvdb_id = ? ORDER BY season, episode', (tvdb_id,)).fetchall()
+        return self.series_item(row, eps)
+
+    def get_episode(self, tvdb_id, season, episode):
+        """Returns (subtitles, watched) for the episode, where subtitles is None if the episode is not collected."""
+        row = self.conn.execute('SELECT collected, subtitles, watched FROM episodes '
+                                'WHERE tvdb_id = ? AND season = ? AND episode = ?',
+                                (tvdb_id, int(season), int(episode))).fetchone()
+        if not row:
+            return None, False
+        return (_load(row[1]) or []) if row[0] else None, bool(row[2])
+
+    def watchlist(self, kind, tags=None, check_tags='any', episodes=False):
+        """Returns the (id, item) pairs in the movies or series watchlist, filtered by tags as uoccin_emit does and
+        sorted by id."""
+        table, key = ('movies', 'imdb_id') if kind == 'movie' else ('series', 'tvdb_id')
+        sql = 'SELECT * FROM %s WHERE watchlist' % table
+        params = []
+        if tags:
+            sub = 'SELECT id FROM tags WHERE kind = ? AND tag IN (%s)' % ','.join('?' * len(tags))
+            params = [kind] + list(tags)
+            if check_tags == 'all':
+                sub += ' GROUP BY id HAVING COUNT(DISTINCT tag) = %d' % len(set(tags))
+            sql += ' AND %s %s (%s)' % (key, 'NOT IN' if check_tags == 'none' else 'IN', sub)
+        sql += ' ORDER BY %s' % key
+        rows = self.conn.execute(sql, params).fetchall()
+        if kind == 'movie':
+            return [(row[0], self.movie_item(row)) for row in rows]
+        return [(row[0], self.get_series(row[0], True) if episodes else self.series_item(row)) for row in rows]
+
+    def set_names(self, kind, names):
+        """Updates the names of the given {id: name} movies/series. Must be called in a transaction."""
+        table, key = ('movies', 'imdb_id') if kind == 'movie' else ('series', 'tvdb_id')
+        self.conn.executemany('UPDATE %s SET name = ? WHERE %s = ?' % (table, key),
+                              [(name, eid) for eid, name in names.items()])
+
+    def load_items(self, targets):
+        """Returns a document (as in uoccin.json) with just the given (type, id) movies/series."""
+        udata = {'movies': {}, 'series': {}}
+        for typ, tid in targets:
+            if typ == 'movie':
+                mov = self.get_movie(tid)
+                if mov:
+                    udata['movies'][tid] = mov
+            elif typ == 'series':
+                ser = self.get_series(tid, True)
+                if ser:
+                    udata['series'][tid] = ser
+        return udata
+
+    def store_items(self, udata, targets):
+        """Writes back the given (type, id) movies/series from the document (deleting the missing ones).
+        Must be called in a transaction."""
+        cur = self.conn.cursor()
+        for typ, tid in targets:
+            if typ == 'movie':
+                cur.execute('DELETE FROM movies WHERE imdb_id = ?', (tid,))
+                cur.execute("DELETE FROM tags WHERE kind = 'movie' AND id = ?", (tid,))
+                mov = udata['movies'].get(tid)
+                if mov is None:
+                    continue
+                cur.execute('INSERT INTO movies VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (tid, mov.get('name', 'N/A'), mov.get('watchlist', False), mov.get('collected', False),
+                             mov.get('watched', False), mov.get('rating'), _dump(mov.get('tags')),
+                             _dump(mov.get('subtitles'))))
+                cur.executemany("INSERT OR IGNORE INTO tags VALUES ('movie', ?, ?)",
+                                [(tid, tag) for tag in mov.get('tags', [])])
+            elif typ == 'series':
+                cur.execute('DELETE FROM series WHERE tvdb_id = ?', (tid,))
+                cur.execute('DELETE FROM episodes WHERE tvdb_id = ?', (tid,))
+                cur.execute("DELETE FROM tags WHERE kind = 'series' AND id = ?", (tid,))
+                ser = udata['series'].get(tid)
+                if ser is None:
+                    continue
+                cur.execute('INSERT INTO series VALUES (?, ?, ?, ?, ?)',
+                            (tid, ser.get('name', 'N/A'), ser.get('watchlist', False), ser.get('rating'),
+                             _dump(ser.get('tags'))))
+                cur.executemany("INSERT OR IGNORE INTO tags VALUES ('series', ?, ?)",
+                                [(tid, tag) for tag in ser.get('tags', [])])
+                eps = {}
+                for sno, season in ser.get('collected', {}).items():
+                    for eno, subtitles in season.items():
+                        eps[(int(sno), int(eno))] = [True, _dump(subtitles), False]
+                for sno, season in ser.get('watched', {}).items():
+                    for eno in season:
+                        eps.setdefault((int(sno), int(eno)), [False, None, False])[2] = True
+                cur.executemany('INSERT INTO episodes VALUES (?, ?, ?, ?, ?, ?)',
+                                [(tid, k[0], k[1], v[0], v[1], v[2]) for k, v in eps.items()])
+
+    def dump(self):
+        """Returns the whole library as a document (as in uoccin.json)."""
+        udata = {'movies': {}, 'series': {}}
+        for row in self.conn.execute('SELECT * FROM movies'):
+            udata['movies'][row[0]] = self.movie_item(row)
+        episodes = {}
+        for row in self.conn.execute('SELECT tvdb_id, season, episode, collected, subtitles, watched FROM episodes '
+                                     'ORDER BY tvdb_id, season, episode'):
+            episodes.setdefault(row[0], []).append(row[1:])
+        for row in self.conn.execute('SELECT * FROM series'):
+            udata['series'][row[0]] = self.series_item(row, episodes.get(row[0]))
+        return udata
+
+
+def open_uoccin_db(filename, path):
+    """Opens the sqlite database for the uoccin library in path, importing uoccin.json if needed."""
+    try:
+        db = UoccinDatabase(filename, path)
+        db.sync()
+    except sqlite3.Error as err:
+        raise plugin.PluginError('error opening %s: %s' % (filename, err))
+    return db
@@ -0,0 +1,202 @@
+from __future__ import unicode_literals, division, absolute_import
+from builtins import *  # pylint: disable=unused-import, redefined-builtin
+
+import logging
+import os
+import threading
+
+from flexget import plugin
+from flexget.entry import Entry
+from flexget.event import event
+
+from .uoccin_data import is_diff_file
+
+try:
+    # native events: ReadDirectoryChangesW on Windows, inotify on Linux, FSEvents on macOS
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+log = logging.getLogger('uoccin_watch')
+
+# one watcher per task, only started in daemon mode
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def is_foreign_diff(fn, uuid):
+    """Returns True for the diff files sent by the other devices (ours are transient, see uoccin writers)."""
+    return is_diff_file(fn) and uuid not in fn
+
+
+class DiffEventHandler(FileSystemEventHandler):
+    """Sets changed when a foreign diff file is created, written or moved in the watched folder."""
+
+    def __init__(self, uuid, changed):
+        super(DiffEventHandler, self).__init__()
+        self.uuid = uuid
+        self.changed = changed
+
+    def on_any_event(self, evt):
+        if evt.is_directory or evt.event_type == 'deleted':
+            return
+        path = getattr(evt, 'dest_path', None) or evt.src_path
+        if is_foreign_diff(os.path.basename(path), self.uuid):
+            self.changed.set()
+
+
+class DiffWatcher(threading.Thread):
+    """Waits for new foreign diff files in the local device folder and runs the task for them, once per burst.
+    Sleeps until the OS reports a change in the folder, it never lists it."""
+
+    def __init__(self, manager, task_name, folder, uuid, debounce):
+        super(DiffWatcher, self).__init__(name='uoccin_watch.%s' % task_name)
+        self.daemon = True
+        self.manager = manager
+        self.task_name = task_name
+        self.folder = folder
+        self.uuid = uuid
+        self.debounce = debounce
+        self.stopped = threading.Event()
+        self.changed = threading.Event()
+        self.observer = Observer()
+        self.observer.schedule(DiffEventHandler(uuid, self.changed), folder, recursive=False)
+
+    def run(self):
+        self.observer.start()
+        log.verbose('watching %s for new diff files' % self.folder)
+        try:
+            while not self.stopped.is_set():
+                self.changed.wait()
+                # debounce: the cloud client usually drops several files in a row, wait until it's done
+                while not self.stopped.is_set():
+                    self.changed.clear()
+                    if not self.changed.wait(self.debounce):
+                        break
+                if self.stopped.is_set():
+                    break
+                log.verbose('new diff files in %s, running task %s' % (self.folder, self.task_name))
+                self.manager.execute(options={'tasks': [self.task_name]})
+        finally:
+            self.observer.stop()
+            self.observer.join()
+
+    def stop(self):
+        self.stopped.set()
+        self.changed.set()
+
+
+def start_watcher(manager, task_name, config):
+    """Starts (or restarts, if the folder changed) the watcher of the task. Does nothing without watchdog: the task
+    then only runs when scheduled, as with the filesystem input."""
+    if Observer is None:
+        log.verbose('watchdog is not installed, %s will only run when scheduled' % task_name)
+        return
+    folder = os.path.join(config['path'], 'device.' + config['uuid'])
+    with _watchers_lock:
+        watcher = _watchers.get(task_name)
+        if watcher is not None and watcher.is_alive() and watcher.folder == folder:
+            return
+        if watcher is not None:
+            watcher.stop()
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            watcher = DiffWatcher(manager, task_name, folder, config['uuid'], config.get('debounce', 5))
+        except OSError as err:
+            log.warning('unable to watch %s (%s), %s will only run when scheduled' % (folder, err, task_name))
+            return
+        watcher.start()
+        _watchers[task_name] = watcher
+
+
+class UoccinWatch(object):
+    """Provides the foreign diff files found in the local device folder, as the filesystem input would.
+    In daemon mode it also keeps watching the folder and runs the task as soon as new diff files show up, so the task
+    doesn't need to be scheduled often (or at all).
+
+    Example::
+
+      uoccin_sync:
+        uoccin_watch:
+          uuid: '{? uoccin.uuid ?}'
+          path: '{? uoccin.path ?}'
+        accept_all: yes
+        uoccin_reader:
+          uuid: '{? uoccin.uuid ?}'
+          path: '{? uoccin.path ?}'
+
+    Note::
+    - the folder is watched through the watchdog package (native events on Windows, Linux and macOS), started with
+      the daemon. Without watchdog the plugin is a plain input and the task only runs when scheduled.
+    - the task runs once for a burst of files: debounce (default 5) is the number of seconds without new files to
+      wait for before running it.
+    """
+
+    schema = {
+        'type': 'object',
+        'properties': {
+            'uuid': {'type': 'string'},
+            'path': {'type': 'string', 'format': 'path'},
+            'debounce': {'type': 'number', 'minimum': 0, 'default': 5},
+        },
+        'required': ['uuid', 'path'],
+        'additionalProperties': False
+    }
+
+    def on_task_input(self, task, config):
+        folder = os.path.join(config['path'], 'device.' + config['uuid'])
+        if getattr(task.manager, 'is_daemon', False):
+            # already running since the daemon started, unless the config has changed since
+            start_watcher(task.manager, task.name, config)
+        entries = []
+        if not os.path.isdir(folder):
+            return entries
+        for fn in sorted(os.listdir(folder)):
+            if not is_foreign_diff(fn, config['uuid']):
+                continue
+            location = os.path.join(folder, fn)
+            entry = Entry()
+            entry['title'] = fn
+            entry['filename'] = fn
+            entry['location'] = location
+            entry['url'] = 'file://%s' % location
+            entries.append(entry)
+        return entries
+
+
+def watch_config(manager, task_config):
+    """Returns the uoccin_watch config of a task, found in the task itself or in one of its templates."""
+    if 'uoccin_watch' in task_config:
+        return task_config['uoccin_watch']
+    templates = task_config.get('template') or []
+    if not isinstance(templates, list):
+        templates = [templates]
+    for name in templates:
+        template = manager.config.get('templates', {}).get(name) or {}
+        if 'uoccin_watch' in template:
+            return template['uoccin_watch']
+    return None
+
+
+@event('manager.daemon.started')
+def start_watchers(manager):
+    for task_name, task_config in manager.config.get('tasks', {}).items():
+        config = watch_config(manager, task_config or {})
+        if config:
+            start_watcher(manager, task_name, config)
+
+
+@event('manager.shutdown')
+def stop_watchers(manager):
+    with _watchers_lock:
+        for watcher in _watchers.values():
+            watcher.stop()
+        _watchers.clear()
+
+
+@event('plugin.register')
+def register_plugin():
+    plugin.register(UoccinWatch, 'uoccin_watch', api_ver=2)